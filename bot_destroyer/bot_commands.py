@@ -1,3 +1,5 @@
+import functools
+
 from nio import AsyncClient, MatrixRoom, RoomMessageText, RoomMessagesError
 from bot_destroyer import commands_help
 
@@ -6,8 +8,29 @@ from bot_destroyer.config import Config
 from bot_destroyer.destroy_loop import Destroyer, Room
 from bot_destroyer.storage import Storage
 
+_HELP_MESSAGES = {
+    "commands": commands_help.AVAILABLE_COMMANDS,
+    "enable": commands_help.COMMAND_ENABLE,
+    "disable": commands_help.COMMAND_DISABLE,
+    "delay": commands_help.COMMAND_DELAY,
+}
+
 
 class Command:
+    # A Command is built for every command message, avoid a per-instance __dict__
+    __slots__ = (
+        "client",
+        "store",
+        "config",
+        "command",
+        "event_room",
+        "room",
+        "event",
+        "verb",
+        "args",
+        "_say",
+    )
+
     def __init__(
         self,
         client: AsyncClient,
@@ -39,94 +62,84 @@ class Command:
         self.event_room = room
         self.room = None
         self.event = event
-        self.args = self.command.split()[1:]
+        self._say = functools.partial(send_text_to_room, client, room.room_id)
+
+        verb, _, rest = self.command.strip().partition(" ")
+        self.verb = verb
+        self.args = rest.split() if rest else []
 
     async def process(self):
-        """Process the command"""
-        
-        # Ignore any commands from non-admins
-        if self.event_room.power_levels.get_user_level(self.event.sender) != 100:
-            return
+        """Process the command. Callers must have checked the sender is a room admin."""
         
         self.room = Room.get_existing(self.client, self.store, self.event_room.room_id)
         
         if not self.room:
-            await send_text_to_room(self.client, self.event_room.room_id, "Room not initialized, initializing...")
+            await self._say("Room not initialized, initializing...")
             self.room = Room.create_new(self.client, self.store, self.event_room.room_id)
         
-        if self.command.startswith("help"):
-            await self._show_help()
-        elif self.command.startswith("enable"):
-            await self._enable()
-        elif self.command.startswith("disable"):
-            await self._disable()
-        elif self.command.startswith("delay"):
-            await self._delay()
-        elif self.command.startswith("confirm"):
-            await self._confirm()
-        else:
-            await self._unknown_command()
+        handler = self._DISPATCH.get(self.verb, Command._unknown_command)
+        await handler(self)
 
     async def _disable(self):
         """Disable message deletion"""
         
         if not self.room.deletion_turned_on:
-            await send_text_to_room(self.client, self.event_room.room_id, "Deletion already disabled.")
+            await self._say("Deletion already disabled.")
             return
         
-        disabled = self.room.disable_room_loop()
+        disabled = await self.room.disable_room_loop()
         
         if disabled:
-            await send_text_to_room(self.client, self.event_room.room_id, "Deletion disabled.")
+            await self._say("Deletion disabled.")
         else:
-            await send_text_to_room(self.client, self.event_room.room_id, "Failed to disable room deletion.")
+            await self._say("Failed to disable room deletion.")
     
     async def _enable(self):
         """Request to enable message deletion"""
         
         if self.room.deletion_turned_on:
-            await send_text_to_room(self.client, self.event_room.room_id, "Deletion turned on.")
+            await self._say("Deletion turned on.")
             return
         
         if not self.room.delete_after_m:
-            await send_text_to_room(self.client, self.event_room.room_id, "Message timeout not set. Set using `!c delay <delay in minutes>`")
+            await self._say("Message timeout not set. Set using `!c delay <delay in minutes>`")
             return
         
         if not self.event_room.power_levels.can_user_redact(self.client.user_id):
-            await send_text_to_room(self.client, self.event_room.room_id, "Bot does not have permission to redact timeline events.")
+            await self._say("Bot does not have permission to redact timeline events.")
             return
         
         try:
             first_event_id = await self.room.fetch_first_event_id()
         except Exception as e:
-            await send_text_to_room(self.client, self.event_room.room_id, f"Failed to fetch messages with error: {e}.")
+            await self._say(f"Failed to fetch messages with error: {e}.")
             return
         if not first_event_id:
-            await send_text_to_room(self.client, self.event_room.room_id, "No messages will be deleted currently.")
+            await self._say("No messages will be deleted currently.")
         else:
-            await send_text_to_room(self.client, self.event_room.room_id, "All messages above this message will be deleted.", reply_to_event_id=first_event_id)
+            await self._say("All messages above this message will be deleted.", reply_to_event_id=first_event_id)
         
         self.room.accept_requested = True
-        await send_text_to_room(self.client, self.event_room.room_id, "To enable message deletion, please confirm with `!c confirm`")
+        await self._say("To enable message deletion, please confirm with `!c confirm`")
 
     async def _confirm(self):
         """Request to enable message deletion confirmation"""
         if not self.room.accept_requested:
-            await send_text_to_room(self.client, self.event_room.room_id, "Nothing to confirm.")
+            await self._say("Nothing to confirm.")
             return
         
         enabled = self.room.enable_room_loop()
 
         if enabled:
-            await send_text_to_room(self.client, self.event_room.room_id, "Deleting old messages.")
+            await self._say("Deleting old messages.")
         else:
-            await send_text_to_room(self.client, self.event_room.room_id, "Failed to start deletion process.")
+            await self._say("Failed to start deletion process.")
 
     async def _delay(self):
         """Delay command"""
         
         if len(self.args) > 1:
-            await send_text_to_room(self.client, self.event_room.room_id, commands_help.COMMAND_DELAY)
+            await self._say(commands_help.COMMAND_DELAY)
             return
         elif len(self.args) == 1:
             await self._set_delay(self.args[0])
@@ -140,26 +153,26 @@ class Command:
         else:
             text = f"Messages are deleted after {self.room.delete_after_m} minutes"
             
-        await send_text_to_room(self.client, self.event_room.room_id, text)
+        await self._say(text)
             
     async def _set_delay(self, delay: str):
-        if not delay.isnumeric():
-            await send_text_to_room(self.client, self.event_room.room_id, "Please enter a numeric delay value in minutes")
+        try:
+            delay_minutes = int(delay)
+        except ValueError:
+            await self._say("Please enter a numeric delay value in minutes")
             return
-        
-        delay_minutes = int(delay)
 
         if delay_minutes <= 0:
-            await send_text_to_room(self.client, self.event_room.room_id, "Delay must be positive")
+            await self._say("Delay must be positive")
             return    
         
         self.room.set_delete_after(delay_minutes)
-        await send_text_to_room(self.client, self.event_room.room_id, f"Messages will be deleted after {delay_minutes} minutes.")
+        await self._say(f"Messages will be deleted after {delay_minutes} minutes.")
   
     async def _echo(self):
         """Echo back the command's arguments"""
         response = " ".join(self.args)
-        await send_text_to_room(self.client, self.event_room.room_id, response)
+        await self._say(response)
 
 
     async def _show_help(self):
@@ -169,22 +182,24 @@ class Command:
                 "Hello, I am bot destroyer. Use `help commands` to view "
                 "available commands."
             )
-            await send_text_to_room(self.client, self.event_room.room_id, text)
+            await self._say(text)
             return
 
-        help_messages = {
-            "commands":commands_help.AVAILABLE_COMMANDS,
-            "enable":commands_help.COMMAND_ENABLE,
-            "disable":commands_help.COMMAND_DISABLE,
-            "delay":commands_help.COMMAND_DELAY,
-        }
         topic = self.args[0]
-        text = help_messages.get(topic,"Unknown help topic!")
-        await send_text_to_room(self.client, self.event_room.room_id, text)
+        text = _HELP_MESSAGES.get(topic, "Unknown help topic!")
+        await self._say(text)
 
     async def _unknown_command(self):
-        await send_text_to_room(
-            self.client,
-            self.event_room.room_id,
-            f"Unknown command '{self.command}'. Try the 'help' command for more information.",
+        # Only echo the verb back, the full command body may be arbitrarily long
+        await self._say(
+            f"Unknown command '{self.verb}'. Try the 'help' command for more information."
         )
+
+    # Command verb -> handler, resolved once at class creation
+    _DISPATCH = {
+        "help": _show_help,
+        "enable": _enable,
+        "disable": _disable,
+        "delay": _delay,
+        "confirm": _confirm,
+    }
@@ -3,7 +3,9 @@ from typing import TYPE_CHECKING
 
 import asyncio
 import logging
-from datetime import datetime
+import time
+from collections import deque
+from contextlib import asynccontextmanager
 
 # noinspection PyPackageRequirements
 from nio import (MatrixRoom, 
@@ -13,6 +15,7 @@ from nio import (MatrixRoom,
                 JoinError,
                 MegolmEvent,
                 RoomMessageText,
+                RoomMessagesError,
                 AsyncClient,
                 )
 from bot_destroyer.bot_commands import Command
@@ -30,6 +33,10 @@ from bot_destroyer.utils import with_ratelimit
 logger = logging.getLogger(__name__)
 
 DUPLICATES_CACHE_SIZE = 1000
+ADMIN_POWER_LEVEL = 100
+INVITE_TIMELINE_LIMIT = 50
+JOIN_ATTEMPTS = 3
+JOIN_MAX_BACKOFF_S = 10
 
 
 class Callbacks(object):
@@ -44,32 +51,56 @@ class Callbacks(object):
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
-        self.received_events = []
+        self._prefix_len = len(self.command_prefix)
+        self.received_events = deque(maxlen=DUPLICATES_CACHE_SIZE)
+        self.received_ids = set()
 
         self.rooms_pending = {}
         self.user_rooms_pending = {}
         self.lock = asyncio.Lock()
+        # mxid -> (lock, number of tasks holding or waiting for it)
+        self.user_locks = {}
         self.items_to_send = 0
         self.main_loop = None
 
-    def trim_duplicates_caches(self):
-        if len(self.received_events) > DUPLICATES_CACHE_SIZE:
-            self.received_events = self.received_events[:DUPLICATES_CACHE_SIZE]
-
     def should_process(self, event_id: str) -> bool:
         logger.debug("Callback received event: %s", event_id)
-        if event_id in self.received_events:
+        if event_id in self.received_ids:
             logger.debug("Skipping %s as it's already processed", event_id)
             return False
-        self.received_events.insert(0, event_id)
+        # The deque drops the oldest id once full - forget it in the lookup set as well
+        if len(self.received_events) == DUPLICATES_CACHE_SIZE:
+            self.received_ids.discard(self.received_events[0])
+        self.received_events.append(event_id)
+        self.received_ids.add(event_id)
         return True
 
+    @asynccontextmanager
+    async def _user_lock(self, mxid: str):
+        """Hold the lock serializing room creation and message queueing for a user, forgotten once unused"""
+        lock, users = self.user_locks.get(mxid, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.user_locks[mxid] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            users = self.user_locks[mxid][1] - 1
+            if users == 0 and mxid not in self.user_rooms_pending:
+                self.user_locks.pop(mxid)
+            else:
+                self.user_locks[mxid] = (lock, users)
+
+    def _is_admin(self, room: MatrixRoom, user_id: str) -> bool:
+        """Check whether a user is a room admin, by the room's current power levels"""
+        return room.power_levels.get_user_level(user_id) == ADMIN_POWER_LEVEL
+
     async def message(self, room: MatrixRoom, event: RoomMessageText):
         # If ignoring old messages, ignore messages older than 5 minutes
-        if (datetime.now() - datetime.fromtimestamp(event.server_timestamp / 1000.0)).total_seconds() > 300:
+        if time.time() - event.server_timestamp / 1000.0 > 300:
             return
-        
-        self.trim_duplicates_caches()
+
         if self.should_process(event.event_id) is False:
             return
         
@@ -79,22 +110,26 @@ class Callbacks(object):
         # Extract the message text
         msg = event.body
 
-        # Ignore messages from ourselves
-        if event.sender == self.client.user:
-            return
-
         # If this looks like an edit, strip the edit prefix
         if msg.startswith(" * "):
             msg = msg[3:]
 
-        # Process as message if in a public room without command prefix
+        # Most messages are plain chat - filter on the command prefix before anything else
         # TODO Implement check of named commands using an array
-        has_command_prefix = msg.startswith(self.command_prefix)
+        if not msg.startswith(self.command_prefix):
+            return
 
-        if has_command_prefix:
-            msg = msg[len(self.command_prefix):]
-            command = Command(self.client, self.store, self.config, msg, room, event)
-            await command.process()
+        # Ignore messages from ourselves
+        if event.sender == self.client.user:
+            return
+
+        # Ignore any commands from non-admins
+        if not self._is_admin(room, event.sender):
+            return
+
+        msg = msg[self._prefix_len:]
+        command = Command(self.client, self.store, self.config, msg, room, event)
+        await command.process()
 
     async def invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -109,37 +144,60 @@ class Callbacks(object):
         
         logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
 
-        # Attempt to join 3 times before giving up
-        for attempt in range(3):
+        # Attempt to join 3 times before giving up, backing off exponentially between attempts
+        for attempt in range(JOIN_ATTEMPTS):
             result = await self.client.join(room.room_id)
-            if type(result) == JoinError:
+            if isinstance(result, JoinError):
                 logger.error(
                     f"Error joining room {room.room_id} (attempt %d): %s",
                     attempt,
                     result.message,
                 )
+                if attempt < JOIN_ATTEMPTS - 1:
+                    await asyncio.sleep(min(2 ** attempt, JOIN_MAX_BACKOFF_S))
             else:
                 break
         else:
             logger.error("Unable to join room: %s", room.room_id)
+            return
 
         # Successfully joined room
         logger.info(f"Joined {room.room_id}")
-        # Send out key request for encrypted events in room so we can accept the m.forwarded_room_key event
-        response = await self.client.sync()
-        for joined_room_id, room_info in response.rooms.join.items():
-            if joined_room_id == room.room_id:
-                for ev in room_info.timeline.events:
-                    if type(ev) is MegolmEvent:
-                        try:
-                            # Request keys for the event and update the client store
-                            if ev in self.client.outgoing_key_requests:
-                                logger.debug("popping the session request")
-                                self.client.outgoing_key_requests.pop(ev.session_id)
-                            room_key_response = await self.client.request_room_key(ev)
-                            await self.client.receive_response(room_key_response)
-                        except Exception as e:
-                            logger.info(f"Error requesting key for event: {e}")
+        # Send out key request for encrypted events in room so we can accept the m.forwarded_room_key event.
+        # Only the joined room's timeline is fetched - a full sync would pull every room.
+        response = await self.client.room_messages(
+            room.room_id, start=self.client.next_batch, limit=INVITE_TIMELINE_LIMIT
+        )
+        if isinstance(response, RoomMessagesError):
+            logger.error(f"Failed to fetch messages of {room.room_id}: {response.message}")
+            return
+
+        # One key request per megolm session is enough to decrypt all of its events
+        megolm_events = {}
+        for ev in response.chunk:
+            if isinstance(ev, MegolmEvent):
+                megolm_events.setdefault(ev.session_id, ev)
+
+        for session_id in megolm_events:
+            if self.client.outgoing_key_requests.pop(session_id, None) is not None:
+                logger.debug("popping the session request")
+
+        # Request keys for the events concurrently and update the client store
+        room_key_responses = await asyncio.gather(
+            *(self.client.request_room_key(ev) for ev in megolm_events.values()),
+            return_exceptions=True,
+        )
+        results = await asyncio.gather(
+            *(
+                self.client.receive_response(room_key_response)
+                for room_key_response in room_key_responses
+                if not isinstance(room_key_response, Exception)
+            ),
+            return_exceptions=True,
+        )
+        for e in room_key_responses + results:
+            if isinstance(e, Exception):
+                logger.info(f"Error requesting key for event: {e}")
 
     async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
         """Callback for when a room member event is received.
@@ -148,66 +206,73 @@ class Callbacks(object):
             event (nio.events.room_events.RoomMemberEvent): The event
         """
         logger.debug(
-            f"Received a room member event for {room.display_name} | "
-            f"{event.sender}: {event.membership}"
+            "Received a room member event for %s | %s: %s",
+            room.display_name,
+            event.sender,
+            event.membership,
         )
-        async with self.lock:
-            self.trim_duplicates_caches()
-            if self.should_process(event.event_id) is False:
-                return
+        if self.should_process(event.event_id) is False:
+            return
 
-            # Ignore messages older than 15 seconds
-            if (
-                datetime.now() - datetime.fromtimestamp(event.server_timestamp / 1000.0)
-            ).total_seconds() > 15:
-                logger.debug("Ignoring old member event")
-                return
+        # Ignore messages older than 15 seconds
+        if time.time() - event.server_timestamp / 1000.0 > 15:
+            logger.debug("Ignoring old member event")
+            return
 
-            # Ignore if it was not us sending the invite
-            if event.sender != self.client.user:
-                logger.debug("Ignoring member event since it was not sent by us")
-                return
+        # Ignore if it was not us sending the invite
+        if event.sender != self.client.user:
+            logger.debug("Ignoring member event since it was not sent by us")
+            return
 
-            # Ignore if any other membership event
-            if (
-                event.membership != "invite"
-            ):  # or event.prev_content is None or event.prev_content.get("membership") == "join":
-                logger.debug("Ignoring due to not being an invite")
-                return
+        # Ignore if any other membership event
+        if (
+            event.membership != "invite"
+        ):  # or event.prev_content is None or event.prev_content.get("membership") == "join":
+            logger.debug("Ignoring due to not being an invite")
+            return
 
-            # Ignore event, if no messages waiting to be processed
-            if room.room_id not in self.rooms_pending.keys():
-                logger.debug("Ignoring due to no messages waiting to be processed")
-                return
+        # Wait for any room creation for the invited user to finish queueing its messages
+        receiving_user = event.state_key
+        async with self._user_lock(receiving_user):
+            async with self.lock:
+                # Ignore event, if no messages waiting to be processed
+                if room.room_id not in self.rooms_pending:
+                    logger.debug("Ignoring due to no messages waiting to be processed")
+                    return
+
+                # Check if this is the invited user, other than us
+                if receiving_user not in self.user_rooms_pending:
+                    logger.debug("Ignoring, since invited user does not have pending rooms")
+                    return
+                elif room.room_id not in self.user_rooms_pending[receiving_user]:
+                    logger.debug(
+                        "Ignoring, since room id does not match any pending room in user room queue"
+                    )
+                    return
 
-            # Check if this is the invited user, other than us
-            receiving_user = event.state_key
-            if receiving_user not in self.user_rooms_pending.keys():
-                logger.debug("Ignoring, since invited user does not have pending rooms")
-                return
-            elif room.room_id not in self.user_rooms_pending[receiving_user]:
                 logger.debug(
-                    "Ignoring, since room id does not match any pending room in user room queue"
+                    "Received invite to: %s Pending messages for room / Total messages: %d / %d",
+                    room.room_id,
+                    len(self.rooms_pending[room.room_id]),
+                    self.items_to_send,
                 )
-                return
 
-            logger.debug(
-                f"Received invite to: {room.room_id}"
-                f"Pending messages for room / Total messages: {len(self.rooms_pending[room.room_id])} / {self.items_to_send}"
-            )
+                # Take processed room messages off the queue
+                pending_messages = self.rooms_pending.pop(room.room_id)
+                self.user_rooms_pending[receiving_user].remove(room.room_id)
 
-            # Send all pending messages for the room
-            for message_task in self.rooms_pending[room.room_id]:
-                await message_task  # TODO: Missing error handling here
-                self.items_to_send -= 1
+                # If user has no more pending rooms - remove from queue
+                if len(self.user_rooms_pending[receiving_user]) == 0:
+                    self.user_rooms_pending.pop(receiving_user)
 
-            # Clear processed room messages from queue
-            self.rooms_pending.pop(room.room_id)
-            self.user_rooms_pending[receiving_user].remove(room.room_id)
+            # Send all pending messages for the room concurrently, without holding the shared lock
+            results = await asyncio.gather(*pending_messages, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to send pending message to {room.room_id}: {result}")
 
-            # If user has no more pending rooms - remove from queue
-            if len(self.user_rooms_pending[receiving_user]) == 0:
-                self.user_rooms_pending.pop(receiving_user)
+        async with self.lock:
+            self.items_to_send -= len(results)
 
             # Check if that was the last messages to be sent - exit the program.
             if self.items_to_send == 0:
@@ -231,30 +296,30 @@ class Callbacks(object):
 
         room_initialized = True
 
-        # Acquire lock to process room for user - so duplicate room requests are not sent.
-        async with self.lock:
+        # Acquire the user's lock to process their room - so duplicate room requests are not sent.
+        # The shared lock is only held around the pending queue updates, never across requests.
+        async with self._user_lock(mxid):
             # Sends private message to user. Returns true on success.
             if room_id is None:
-                logger.debug(f"Searching for an existing room for {mxid}")
-                msg_room = find_private_msg(self.client, mxid)
-                if msg_room is not None:
-                    room_id = msg_room.room_id
-                    logger.debug(f"Found existing room for {mxid}: {room_id}")
-                elif mxid in self.user_rooms_pending.keys():
-                    room_id = self.user_rooms_pending[mxid]
-                    logger.debug(f"Room is being created for {mxid}: {room_id}")
-                    room_initialized = False
+                async with self.lock:
+                    logger.debug("Searching for an existing room for %s", mxid)
+                    msg_room = find_private_msg(self.client, mxid)
+                    if msg_room is not None:
+                        room_id = msg_room.room_id
+                        logger.debug("Found existing room for %s: %s", mxid, room_id)
+                    elif mxid in self.user_rooms_pending:
+                        room_id = self.user_rooms_pending[mxid][0]
+                        logger.debug("Room is being created for %s: %s", mxid, room_id)
+                        room_initialized = False
 
             # If an existing room was not found - create a new one.
             if room_id is None:
-                logger.debug(f"Creating a new room for {mxid}")
+                logger.debug("Creating a new room for %s", mxid)
                 resp = await create_private_room(self.client, mxid, roomname)
 
                 if isinstance(resp, RoomCreateResponse):
                     room_id = resp.room_id
                     room_initialized = False
-                    if room_id not in self.rooms_pending.keys():
-                        self.rooms_pending[room_id] = []
                 else:
                     logger.error(f"Failed to create room for {mxid}")
                     return
@@ -275,25 +340,30 @@ class Callbacks(object):
             # Based on if the room is initialized - execute the task now, or defer execution until user has been invited to the room
             if room_initialized:
                 await task
-                logger.debug(f"Message sent to {mxid} in room {room_id}")
+                logger.debug("Message sent to %s in room %s", mxid, room_id)
+            else:
+                async with self.lock:
+                    self.rooms_pending.setdefault(room_id, []).append(task)
+                    if mxid not in self.user_rooms_pending:
+                        self.user_rooms_pending[mxid] = [room_id]
+
+                logger.debug(
+                    "Message appended to queue to be sent to %s in room %s", mxid, room_id
+                )
 
+        async with self.lock:
+            if room_initialized:
                 # Decrement task counter
                 self.items_to_send -= 1
 
                 # Check if that was the last messages to be sent - exit the program.
                 if self.items_to_send == 0:
                     self.main_loop.cancel()
-            else:
-                self.rooms_pending[room_id].append(task)
-                if mxid not in self.user_rooms_pending.keys():
-                    self.user_rooms_pending[mxid] = [room_id]
-
-                logger.debug(
-                    f"Message appended to queue to be sent to {mxid} in room {room_id}"
-                )
 
+            # Lazy formatting - the queues are only repr'd when debug logging is enabled
             logger.debug(
-                f"Messages left to send: {self.items_to_send}"
-                f"Room message queue: {self.rooms_pending}"
-                f"Pending User room queue: {self.user_rooms_pending}"
+                "Messages left to send: %s Room message queue: %s Pending User room queue: %s",
+                self.items_to_send,
+                self.rooms_pending,
+                self.user_rooms_pending,
             )
@@ -108,6 +108,16 @@ class Config:
         
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
+        # Number of events to request per page when paginating room history
+        self.page_size = self._get_cfg(["page_size"], default=1000)
+        if not isinstance(self.page_size, int) or self.page_size <= 0:
+            raise ConfigError("page_size must be a positive integer")
+
+        # Number of redactions sent to the homeserver at once, across all rooms
+        self.redact_workers = self._get_cfg(["redact_workers"], default=4)
+        if not isinstance(self.redact_workers, int) or self.redact_workers <= 0:
+            raise ConfigError("redact_workers must be a positive integer")
+
     def _get_cfg(
         self,
         path: List[str],
@@ -1,17 +1,30 @@
 from __future__ import annotations
 import asyncio
-from typing import TYPE_CHECKING
+import functools
+from typing import TYPE_CHECKING, Any, AsyncIterable, AsyncIterator, Dict, Optional
 import random
-from datetime import datetime
+import time
 import logging
-from nio import AsyncClient, RoomMessagesResponse, Event, RoomMessagesError, MessageDirection, RoomRedactError, RoomContextError, RoomContextResponse
+from nio import Api, AsyncClient, MatrixRoom, Event, RoomMemberEvent, RoomMessagesError, MessageDirection, RoomRedactError, RoomContextError, SyncResponse
 from bot_destroyer.chat_functions import send_room_redact, send_text_to_room
 
 from bot_destroyer.storage import Storage
 
 logger = logging.getLogger(__name__)
 
-persist_event_types = [
+# Maximum number of redactions a room has queued or in flight at once
+REDACT_CONCURRENCY = 8
+# Number of workers sending redactions for all rooms, to stay clear of homeserver rate limits
+DEFAULT_REDACT_WORKERS = 4
+# Number of events requested per history page. Homeservers cap this, Synapse at 1000.
+DEFAULT_PAGE_SIZE = 1000
+# Maximum number of rooms scanning their history at once when the bot starts
+STARTUP_SCAN_CONCURRENCY = 8
+# Fallback rescan interval for rooms without a pending expired event
+IDLE_RESCAN_S = 300
+
+# Event types that are never deleted
+PERSIST_EVENT_TYPES = frozenset({
             "m.room.server_acl",
             "m.room.encryption",
             "m.room.name",
@@ -25,7 +38,16 @@ persist_event_types = [
             "m.room.member",
             "m.room.redaction",
             "default",
-        ]
+        })
+# Server side filter for history pages, so events that are never deleted are not sent to the bot at all
+HISTORY_FILTER = {
+    "not_types": sorted(PERSIST_EVENT_TYPES - {"default"}),
+    "lazy_load_members": True,
+}
+
+def now_ms() -> int:
+    """Current time in ms since the epoch, the unit of event server timestamps"""
+    return int(time.time() * 1000)
 
 class IEvent(object):
     def __init__(self, event_id:str = None, timestamp:str = None, batch_token_start: str = None, batch_token_end: str = None):
@@ -37,18 +59,22 @@ class IEvent(object):
 class Room(object):
     
     room_cache = {}
+    # Events per history page, set from the config by the Destroyer
+    page_size = DEFAULT_PAGE_SIZE
     
     def __init__(self,
                  client: AsyncClient,
                  storage: Storage, 
                  room_id:str, 
+                 fields: Optional[Dict[str, Any]] = None,
                  ):
         
         self.client = client
         self.storage = storage
         
-        # Fetch existing fields of Room
-        fields = self.storage.get_room_all(room_id)
+        # Fetch existing fields of Room, unless already loaded by the caller
+        if fields is None:
+            fields = self.storage.get_room_all(room_id)
         
         self.room_id =            fields['room_id']
         
@@ -57,206 +83,405 @@ class Room(object):
         self.batch_token_start =        fields['batch_token_start']
         self.batch_token_end =        fields['batch_token_end']
         
-        self.deletion_turned_on = fields['deletion_turned_on']
+        self.deletion_turned_on = bool(fields['deletion_turned_on'])
         self.delete_after_m =     fields['delete_after']
         
+        # Expiry window in ms, kept alongside the minutes to compare directly with event timestamps
+        self.delete_after_ms = None
         if self.delete_after_m is not None:
             self.delete_after_m = int(self.delete_after_m)
-            
-        if self.deletion_turned_on is not None:
-            self.deletion_turned_on = self.deletion_turned_on == '1'
+            self.delete_after_ms = self.delete_after_m * 60_000
             
         if self.timestamp is not None:
             self.timestamp = int(self.timestamp)
         
-        self.room = self.client.rooms.get(self.room_id, None)
         self.accept_requested = False
         
-    def set_event(self, event_id: str, timestamp: str, batch_token_start: str, batch_token_end: str):
+        # Set to wake the room loop up early, e.g. when a new event arrives
+        self._wake = asyncio.Event()
+        # Timestamp of the oldest event received since the room was last scanned
+        self.pending_event_timestamp = None
+    
+    @property
+    def room(self) -> Optional[MatrixRoom]:
+        """The client's current state of the room, looked up on access so it never goes stale"""
+        return self.client.rooms.get(self.room_id, None)
+        
+    async def set_event(self, event_id: str, timestamp: str, batch_token_start: str, batch_token_end: str):
         self.last_event_id = event_id
         self.timestamp = timestamp
         self.batch_token_start = batch_token_start
         self.batch_token_end = batch_token_end
         
-        self.storage.set_room_event(self.room_id, self.last_event_id, self.timestamp, self.batch_token_start, batch_token_end)
+        # Write from a worker thread, so the database does not block other rooms' loops
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                self.storage.set_room_event, self.room_id, self.last_event_id, self.timestamp, self.batch_token_start, batch_token_end
+            ),
+        )
         
     def set_delete_after(self, delete_after_m):
         self.delete_after_m = delete_after_m
+        self.delete_after_ms = delete_after_m * 60_000
         self.storage.set_delete_after(self.room_id, delete_after_m)
 
-    def event_expired(self, event: Event) -> bool:
-        time_to_expiry = self.get_time_to_expiry_in_min(event.server_timestamp)
+    def event_expired(self, event: Event, current_ms: Optional[int] = None) -> bool:
+        # Pass `current_ms` to reuse one clock read across a batch of events
+        if current_ms is None:
+            current_ms = now_ms()
         
-        return time_to_expiry < 0
+        return current_ms - event.server_timestamp > self.delete_after_ms
     
-    def get_time_to_expiry_in_min(self, timestamp:int) -> int:
-        event_time = datetime.fromtimestamp(timestamp / 1000.0)
-        current_time = datetime.now()
+    def get_expiry_cutoff_ms(self) -> int:
+        """Timestamp in ms before which events are expired"""
+        return now_ms() - self.delete_after_ms
+    
+    def get_time_to_expiry_in_min(self, timestamp:int, current_ms: Optional[int] = None) -> float:
+        if current_ms is None:
+            current_ms = now_ms()
         
-        return self.delete_after_m-(current_time - event_time).total_seconds()/60
+        return (timestamp + self.delete_after_ms - current_ms) / 60_000.0
         
     def enable_room_loop(self):
         self.deletion_turned_on = True
         self.accept_requested = False
-        self.storage.set_deletion_turned_on(self.room_id, '1')
+        self.storage.set_deletion_turned_on(self.room_id, True)
+        self.wake()
         
         return Destroyer.start_room_loop(self)
     
-    def disable_room_loop(self):
+    async def disable_room_loop(self):
         logger.debug("Disabling room loop")
         self.deletion_turned_on = False
-        self.storage.set_deletion_turned_on(self.room_id, '0')
+        self.storage.set_deletion_turned_on(self.room_id, False)
+        self.wake()
         
-        return Destroyer.stop_room_loop(self)
+        return await Destroyer.stop_room_loop(self)
 
-    def event_is_redacted(self, ev: Event) -> bool:
-        return False
-    
-    def event_redaction(self, ev:Event) -> bool:
-        if ev.source.get("type", "default") == "m.room.redaction" and ev.source.get("sender", "") == self.client.user_id:
-            return True
-        return False
-    
-    def event_redacted(self, ev:Event) -> bool:
-        if ev.source.get("redacted_because", {}).get("type", "default") == "m.room.redaction":
-            return True
-        return False
-    
-    def event_redacted_by_bot(self, ev:Event) -> bool:
-        if self.event_redacted(ev) and ev.source.get("redacted_because", {}).get("sender", "default") == self.client.user_id:
-            return True
-        return False
+    def prefetch_page(self, start: Optional[str], end: Optional[str], direction: MessageDirection) -> Optional[asyncio.Task]:
+        """Start fetching the page following the `start`-`end` page in the background, if there is one"""
+        if end is None or start == end:
+            return None
+        return asyncio.create_task(self.client.room_messages(self.room_id, end, direction = direction, limit = self.page_size))
 
     async def delete_previous_events(self) -> str:
-        resp = RoomMessagesResponse("", [], None, self.batch_token_end)
+        # Pagination tokens of the current page
+        start, end = None, self.batch_token_end
         exit_loop = False   
         delete_from_block_token = None
         
         # Find first undeleted event by bot
-        while(resp.start != resp.end and not exit_loop and resp.end is not None):
-            resp = await self.client.room_messages(self.room_id, resp.end, limit = 100)
-            if type(resp) == RoomMessagesError:
-                logger.error(resp)
-                raise Exception(resp.status_code)
-            for ev in resp.chunk:
-                
-                if self.event_redacted_by_bot(ev):
-                    delete_from_block_token = resp.end
-                    exit_loop = True
-                            
-                if exit_loop:
-                    break
+        next_page = self.prefetch_page(start, end, MessageDirection.back)
+        try:
+            while next_page is not None and not exit_loop:
+                resp = await next_page
+                if isinstance(resp, RoomMessagesError):
+                    logger.error(resp)
+                    raise Exception(resp.status_code)
+                start, end = resp.start, resp.end
+                # Request the following page while this one is scanned
+                next_page = self.prefetch_page(start, end, MessageDirection.back)
+                user_id = self.client.user_id
+                for ev in resp.chunk:
+                    
+                    # Stop at the last event redacted by the bot
+                    redacted_because = ev.source.get("redacted_because")
+                    if (
+                        redacted_because
+                        and redacted_because.get("type") == "m.room.redaction"
+                        and redacted_because.get("sender") == user_id
+                    ):
+                        delete_from_block_token = end
+                        exit_loop = True
+                        break
+        finally:
+            if next_page is not None:
+                next_page.cancel()
         
         if delete_from_block_token is None:
-            delete_from_block_token = resp.end
+            delete_from_block_token = end
             
         if delete_from_block_token is None or delete_from_block_token == '':
             delete_from_block_token = "t00-000000_0_0_0_0_0_0_0_0"
             
-        resp.end = delete_from_block_token
-            
-        exit_loop = False
-        while(resp.start != resp.end and not exit_loop and resp.end is not None):
-            resp = await self.client.room_messages(self.room_id, resp.end, direction = MessageDirection.front, limit = 100)
-            if type(resp) == RoomMessagesError:
-                logger.error(resp)
-                raise Exception(resp.status_code)
-            
-            for ev in resp.chunk:
-                
-                # Exit when found first event
-                if ev.event_id == self.last_event_id:
-                    exit_loop = True
-                    break
-                
-                if self.event_redacted(ev):
-                    continue
-                if self.event_redaction(ev):
-                    continue
-                if ev.source.get("type", "default") in persist_event_types:
-                    continue
+        end = delete_from_block_token
+        
+        # Redact expired events as the forward scan finds them, while it keeps paginating
+        event_ids = self.iter_expired_event_ids(start, end)
+        try:
+            await self.redact_events(event_ids)
+        finally:
+            # Stop the scan and drop its prefetched page if the redactions failed
+            await event_ids.aclose()
+
+    async def iter_expired_event_ids(self, start: Optional[str], end: Optional[str]) -> AsyncIterator[str]:
+        """Yield expired events forwards from the `start`-`end` page, oldest first, up to the last event.
+        
+        The following page is fetched while the events of the current one are consumed.
+        """
+        next_page = self.prefetch_page(start, end, MessageDirection.front)
+        try:
+            while next_page is not None:
+                resp = await next_page
+                if isinstance(resp, RoomMessagesError):
+                    logger.error(resp)
+                    raise Exception(resp.status_code)
+                start, end = resp.start, resp.end
+                # Request the following page while this one is consumed
+                next_page = self.prefetch_page(start, end, MessageDirection.front)
                 
-                if self.event_expired(ev):
-                    redact_resp = await send_room_redact(self.client, self.room_id, ev.event_id)
-                    if type(redact_resp) == RoomRedactError:
-                        logger.error(redact_resp)
-                        raise Exception(redact_resp.status_code)
-                else:
-                    logger.error("Found non-expired messages before first message to be deleted.")
-                    raise Exception("Found non-expired messages before first message to be deleted")
-                if exit_loop:
-                    break
+                # Events sent before the cutoff have expired
+                cutoff_ms = self.get_expiry_cutoff_ms()
+                user_id = self.client.user_id
+                for ev in resp.chunk:
+                    
+                    # Exit when found first event
+                    if ev.event_id == self.last_event_id:
+                        return
+                    
+                    # Read each event field once - skip redacted events, the bot's redactions and persisted types
+                    source = ev.source
+                    redacted_because = source.get("redacted_because")
+                    if redacted_because and redacted_because.get("type") == "m.room.redaction":
+                        continue
+                    ev_type = source.get("type", "default")
+                    if ev_type == "m.room.redaction" and source.get("sender") == user_id:
+                        continue
+                    if ev_type in PERSIST_EVENT_TYPES:
+                        continue
+                    
+                    if ev.server_timestamp >= cutoff_ms:
+                        logger.error("Found non-expired messages before first message to be deleted.")
+                        raise Exception("Found non-expired messages before first message to be deleted")
+                    yield ev.event_id
+        finally:
+            # Drop a page fetched speculatively past the last event, or left over after an error
+            if next_page is not None:
+                next_page.cancel()
 
+    async def redact_events(self, event_ids: AsyncIterable[str]):
+        """Redact events as they are produced, a bounded number at a time. Raises on the first failed redaction.
+        
+        Redactions already sent are waited for before raising. They complete in any order, so a failed
+        event may be left before later events that were redacted.
+        """
+        semaphore = asyncio.Semaphore(REDACT_CONCURRENCY)
+        in_flight = set()
+        failures = []
+        
+        async def redact(event_id: str):
+            try:
+                redact_resp = await Destroyer.redact(self.client, self.room_id, event_id)
+                if isinstance(redact_resp, RoomRedactError):
+                    failures.append(redact_resp)
+            except Exception as e:
+                # Record errors raised by the request as well, the task's own exception is never retrieved
+                failures.append(e)
+            finally:
+                semaphore.release()
+        
+        def raise_on_failure():
+            if failures:
+                failure = failures[0]
+                logger.error(failure)
+                if isinstance(failure, Exception):
+                    raise failure
+                raise Exception(failure.status_code)
+        
+        try:
+            async for event_id in event_ids:
+                # Wait for a free slot, which also keeps the producer from running far ahead of the redactions
+                await semaphore.acquire()
+                raise_on_failure()
+                task = asyncio.create_task(redact(event_id))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except asyncio.CancelledError:
+            # The room loop is being stopped - abandon the queued redactions
+            for task in list(in_flight):
+                task.cancel()
+            raise
+        finally:
+            # Let the redactions already sent finish, also when the producer or a redaction failed
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+        raise_on_failure()
+
+    async def find_event_before(self, timestamp_ms: int) -> Optional[str]:
+        """Ask the homeserver for the last event sent before `timestamp_ms` (MSC3030).
+        
+        Returns None if there is no such event or the homeserver does not support the endpoint.
+        """
+        if not Destroyer.timestamp_lookup_supported:
+            return None
+        
+        path = Api._build_path(
+            ["rooms", self.room_id, "timestamp_to_event"],
+            {"access_token": self.client.access_token, "ts": timestamp_ms, "dir": "b"},
+            base_path="/_matrix/client/v1",
+        )
+        try:
+            resp = await self.client.send("GET", path)
+        except Exception as e:
+            logger.debug("Room %s timestamp lookup failed with error: %s", self.room_id, e)
+            return None
+        
+        # Read the body on every path, which also releases the connection
+        try:
+            content = await resp.json()
+        except Exception as e:
+            logger.debug("Room %s timestamp lookup returned an unreadable body: %s", self.room_id, e)
+            content = {}
+        finally:
+            resp.release()
+        
+        if resp.status != 200:
+            # M_NOT_FOUND means there is no event before the timestamp, anything else that the endpoint is missing
+            if resp.status in (404, 405) and content.get("errcode") != "M_NOT_FOUND":
+                logger.info("Homeserver does not support timestamp lookups, scanning history from the latest event")
+                Destroyer.timestamp_lookup_supported = False
+            else:
+                logger.debug("Room %s timestamp lookup failed with status %s", self.room_id, resp.status)
+            return None
+        
+        return content.get("event_id")
+    
+    async def get_history_token_before(self, timestamp_ms: int) -> str:
+        """Pagination token to scan backwards from the last event sent before `timestamp_ms`.
+        
+        Falls back to the client's sync token, i.e. the latest event, if the homeserver cannot look the event up.
+        """
+        # Stored batch tokens are not a safe starting point - events newer than them may have expired since
+        sync_token = self.client.next_batch or ""
+        
+        event_id = await self.find_event_before(timestamp_ms)
+        if event_id is None:
+            return sync_token
+        
+        # The context end token sits right after the event (and at most one event after it)
+        resp = await self.client.room_context(self.room_id, event_id, limit = 1)
+        if isinstance(resp, RoomContextError) or resp.end is None:
+            return sync_token
+        return resp.end
+    
     async def fetch_first_event_id(self) -> str:
         # Go over all events in the room (break if we find the first timed out event) and return the event id
         
         if not self.delete_after_m:
             return None
         
-        resp = RoomMessagesResponse("", [], None, "")
+        # Everything sent after the cutoff is not expired yet, start scanning at the cutoff
+        end = await self.get_history_token_before(self.get_expiry_cutoff_ms())
         exit_loop = False
         iEvent = IEvent()
+        # Timestamp of the oldest event seen that has not expired yet
+        oldest_pending_ms = None
         
-        while(resp.start != resp.end and not exit_loop and resp.end is not None):
-            resp = await self.client.room_messages(self.room_id, resp.end, limit = 100)
-            if type(resp) == RoomMessagesError:
+        while True:
+            resp = await self.client.room_messages(self.room_id, end, limit = self.page_size, message_filter = HISTORY_FILTER)
+            if isinstance(resp, RoomMessagesError):
                 logger.error(resp)
                 raise Exception(resp.status_code)
+            start, end = resp.start, resp.end
+            # Events sent before the cutoff have expired
+            cutoff_ms = self.get_expiry_cutoff_ms()
+            # Pages run newest to oldest - if the oldest event has not expired, nothing on the page has
+            if not resp.chunk or resp.chunk[-1].server_timestamp >= cutoff_ms:
+                if resp.chunk:
+                    oldest_pending_ms = resp.chunk[-1].server_timestamp
+                if end is None or start == end:
+                    break
+                continue
+            
+            user_id = self.client.user_id
             for ev in resp.chunk:
                 
-                if self.event_redacted_by_bot(ev):
+                source = ev.source
+                redacted_because = source.get("redacted_because")
+                # Events before the last one redacted by the bot have been handled already
+                if (
+                    redacted_because
+                    and redacted_because.get("type") == "m.room.redaction"
+                    and redacted_because.get("sender") == user_id
+                ):
                     exit_loop = True
-                elif self.event_redaction(ev):
-                    continue
-                else:
-                    if ev.source.get("type", "default") not in persist_event_types:
-                        if self.event_expired(ev):
-                            iEvent.room_id = ev.event_id
-                            iEvent.timestamp = ev.server_timestamp
-                            iEvent.batch_token_start = resp.end
-                            iEvent.batch_token_end = resp.start
-                            exit_loop = True
-                            
-                if exit_loop:
                     break
+                
+                # Persisted event types are filtered out by the server
+                if ev.server_timestamp < cutoff_ms:
+                    iEvent.room_id = ev.event_id
+                    iEvent.timestamp = ev.server_timestamp
+                    iEvent.batch_token_start = end
+                    iEvent.batch_token_end = start
+                    exit_loop = True
+                    break
+                oldest_pending_ms = ev.server_timestamp
+            
+            # Stop once the event is found or the start of the room is reached
+            if exit_loop or end is None or start == end:
+                break
         
-        self.set_event(iEvent.room_id, iEvent.timestamp, iEvent.batch_token_start, iEvent.batch_token_end)
+        # With nothing expired yet, the loop can sleep until the oldest event seen expires instead of rescanning
+        if iEvent.room_id is None and oldest_pending_ms is not None:
+            if self.pending_event_timestamp is None or oldest_pending_ms < self.pending_event_timestamp:
+                self.pending_event_timestamp = oldest_pending_ms
+        
+        await self.set_event(iEvent.room_id, iEvent.timestamp, iEvent.batch_token_start, iEvent.batch_token_end)
         return iEvent.room_id
     
     async def set_next_event(self):
         
-        resp = RoomContextResponse(None, None, "", None, None, None, None)
         last_event_id = self.last_event_id
         exit_loop = False
         iEvent = IEvent()
         
-        while(resp.start != resp.end and not exit_loop and resp.end is not None):
+        while True:
             
             resp = await self.client.room_context(self.room_id, last_event_id)
-            if type(resp) == RoomContextError:
+            if isinstance(resp, RoomContextError):
                 logger.error(resp)
                 raise Exception(resp.status_code)
-            elif type(resp) == RoomContextResponse:
-                if len(resp.events_after) == 0:
+            if len(resp.events_after) == 0:
+                break
+
+            for ev in resp.events_after:
+                last_event_id = ev.event_id
+                if ev.source.get("type", "default") not in PERSIST_EVENT_TYPES:
+                    iEvent.room_id = ev.event_id
+                    iEvent.timestamp = ev.server_timestamp
+                    iEvent.batch_token_start = resp.start
+                    iEvent.batch_token_end = resp.end
                     exit_loop = True
                     break
-
-                for ev in resp.events_after:
-                    last_event_id = ev.event_id
-                    if ev.source.get("type", "default") not in persist_event_types:
-                        iEvent.room_id = ev.event_id
-                        iEvent.timestamp = ev.server_timestamp
-                        iEvent.batch_token_start = resp.start
-                        iEvent.batch_token_end = resp.end
-                        exit_loop = True
-                    if exit_loop:
-                        break
+            
+            if exit_loop or resp.end is None or resp.start == resp.end:
+                break
                 
-        self.set_event(iEvent.room_id, iEvent.timestamp, iEvent.batch_token_start, iEvent.batch_token_end)
+        await self.set_event(iEvent.room_id, iEvent.timestamp, iEvent.batch_token_start, iEvent.batch_token_end)
     
-    async def main_loop(self):
+    async def scan_expired_events(self) -> bool:
+        """Find the first expired event and delete everything before it. Returns False on failure."""
+        try:
+            first_event_id = await self.fetch_first_event_id()
+        except Exception as e:
+            await send_text_to_room(self.client, self.room_id, f"Failed to fetch next event after none with error: {e}")
+            return False
+        
+        if first_event_id is not None:
+            try:
+                await self.delete_previous_events()
+            except Exception as e:
+                await send_text_to_room(self.client, self.room_id, f"Failed to delete events before next event after none with error: {e}")
+                return False
+        return True
+    
+    async def main_loop(self, scan_limiter: Optional[asyncio.Semaphore] = None):
+        """Delete expired events until deletion is turned off.
+        
+        Pass `scan_limiter` to scan the room's history straight away, sharing the limit with other rooms.
+        """
         logger.debug("Starting loop...")
-        await asyncio.sleep(2)
         
         # Delete all events before the starting event
         if self.last_event_id is not None:
@@ -265,17 +490,28 @@ class Room(object):
             except Exception as e:
                 await send_text_to_room(self.client, self.room_id, f"Failed to delete events before last expired event with error: {e}")
                 return
+        elif scan_limiter is not None:
+            # Catch up on events that expired while the loop was not running
+            async with scan_limiter:
+                if not await self.scan_expired_events():
+                    return
         
         while self.deletion_turned_on:
             
             if self.last_event_id:
                 time_to_sleep_for_in_s = self.get_time_to_expiry_in_min(self.timestamp)*60
                 if time_to_sleep_for_in_s > 0:
-                    logger.debug(f"Room {self.room_id} sleeping for {time_to_sleep_for_in_s/60}m")
-                    await asyncio.sleep(time_to_sleep_for_in_s)
+                    logger.debug("Room %s sleeping for %sm", self.room_id, time_to_sleep_for_in_s/60)
+                    if await self.wait_for_wake(time_to_sleep_for_in_s):
+                        # Woken up early - re-evaluate the loop state
+                        continue
 
-                redact_resp = await send_room_redact(self.client, self.room_id, self.last_event_id)
-                if type(redact_resp) == RoomRedactError:
+                try:
+                    redact_resp = await Destroyer.redact(self.client, self.room_id, self.last_event_id)
+                except Exception as e:
+                    await send_text_to_room(self.client, self.room_id, f"Failed to delete last expired event with error: {e}")
+                    return
+                if isinstance(redact_resp, RoomRedactError):
                     await send_text_to_room(self.client, self.room_id, f"Failed to delete last expired event with error: {redact_resp}")
                     return
                 try:
@@ -284,84 +520,221 @@ class Room(object):
                     await send_text_to_room(self.client, self.room_id, f"Failed to find next event with error: {e}")
                     return
             else:
-                logger.debug("Waiting for default time")
-                await asyncio.sleep(300 + random.randit(0, 300))
-                resp = None
-                try:
-                    resp = await self.fetch_first_event_id()
-                except:
-                    await send_text_to_room(self.client, self.room_id, f"Failed to fetch next event after none with error: {e}")
-                    return
+                if self.pending_event_timestamp is not None:
+                    # Sleep until the oldest event received since the last scan expires
+                    time_to_sleep_for_in_s = max(self.get_time_to_expiry_in_min(self.pending_event_timestamp)*60, 0)
+                else:
+                    # Nothing to expire yet - wait for a new event, rescanning occasionally as a fallback
+                    logger.debug("Waiting for new events")
+                    time_to_sleep_for_in_s = IDLE_RESCAN_S + random.randint(0, IDLE_RESCAN_S)
                 
-                if resp is not None:
-                    try:
-                        await self.delete_previous_events()
-                    except Exception as e:
-                        await send_text_to_room(self.client, self.room_id, f"Failed to delete events before next event after none with error: {e}")
-                        return
+                if time_to_sleep_for_in_s > 0 and await self.wait_for_wake(time_to_sleep_for_in_s):
+                    continue
+                
+                self.pending_event_timestamp = None
+                if not await self.scan_expired_events():
+                    return
+
+    async def wait_for_wake(self, timeout: float) -> bool:
+        """Sleep for up to `timeout` seconds. Returns True if woken up early by `wake`."""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._wake.clear()
+        return True
+
+    def wake(self):
+        """Wake up the room loop so it re-evaluates its state"""
+        self._wake.set()
+
+    def notify_event(self, event: Event):
+        """Let the room loop know a new deletable event has arrived in the room"""
+        if self.pending_event_timestamp is None:
+            self.pending_event_timestamp = event.server_timestamp
+        self.wake()
                     
+    @classmethod
+    def from_row(cls, client: AsyncClient, storage: Storage, row: Dict[str, Any]) -> Room:
+        """Build a Room from an already fetched storage row, without querying the database"""
+        return cls(client, storage, row['room_id'], fields=row)
+    
     @staticmethod
     def get_existing(client: AsyncClient, storage:Storage, room_id:str) -> Room:
         
-        # Check cache first
+        # Check cache first. There is no await between the lookup and the insert below,
+        # so concurrent callers cannot build duplicate rooms.
         room = Room.room_cache.get(room_id, None)
         if room:
             return room
         
-        # Find existing room in storage
-        exists = storage.get_room(room_id)
-        if not exists:
+        # Find existing room in storage, loading all of its fields in the same query
+        fields = storage.get_room_all(room_id)
+        if not fields:
             return None
         else:
-            room = Room(client, storage, room_id)
+            room = Room.from_row(client, storage, fields)
             Room.room_cache[room_id] = room
             return room
 
     @staticmethod
     def create_new(client: AsyncClient, storage:Storage, room_id:str) -> Room:
-        # Create Room entry if not found in DB
-        storage.create_room(room_id)
-        return Room(client, storage, room_id)
+        # Create Room entry if not found in DB. A new entry has only default fields, so skip reading it back.
+        if storage.create_room(room_id):
+            room = Room.from_row(client, storage, Storage.new_room_row(room_id))
+        else:
+            room = Room(client, storage, room_id)
+        # Memoize the new room, so later lookups share the instance its room loop runs on
+        Room.room_cache[room_id] = room
+        return room
+    
+    @staticmethod
+    async def evict(room_id: str):
+        """Drop a room from the cache and stop its loop. Its stored settings are kept."""
+        room = Room.room_cache.pop(room_id, None)
+        if room is not None and room_id in Destroyer.room_tasks:
+            await Destroyer.stop_room_loop(room)
 
 class Destroyer(object):
     room_tasks = {}
+    # (room_id, event_id, future) redactions waiting for a worker, None until a Destroyer is created
+    redact_queue: Optional[asyncio.Queue] = None
+    redact_workers = []
+    # Cleared once the homeserver turns out not to support MSC3030 timestamp lookups
+    timestamp_lookup_supported = True
     
-    def __init__(self, client: AsyncClient, storage: Storage):
+    def __init__(self,
+                 client: AsyncClient,
+                 storage: Storage,
+                 page_size: int = DEFAULT_PAGE_SIZE,
+                 redact_workers: int = DEFAULT_REDACT_WORKERS,
+                 ):
         self.client = client
         self.storage = storage
         
-        room_ids = self.storage.get_all_rooms()
+        Room.page_size = page_size
         
-        for room_id in room_ids:
-            room: Room = Room.get_existing(self.client, self.storage, room_id)
+        # Redactions of every room go through one pool of workers, bounding the bot's total request rate
+        Destroyer.redact_queue = asyncio.Queue()
+        Destroyer.redact_workers = [
+            asyncio.create_task(self.redact_worker(), name=f"redact:{i}") for i in range(redact_workers)
+        ]
+        
+        # Wake room loops up when new events arrive in their rooms
+        self.client.add_event_callback(self.on_room_event, (Event,))
+        # Event callbacks only run for joined and invited rooms - rooms the bot left are read from the sync response
+        self.client.add_response_callback(self.on_sync, (SyncResponse,))
+        
+        # Load the rooms with deletion turned on in a single query. Other rooms are loaded on demand.
+        active = []
+        for row in self.storage.get_active_rooms_all():
+            room_id = row['room_id']
+            room = Room.room_cache.get(room_id, None)
+            if room is None:
+                room = Room.from_row(self.client, self.storage, row)
+                Room.room_cache[room_id] = room
             
-            if room.deletion_turned_on:
-                main_loop = asyncio.get_event_loop()
-                room_task = main_loop.create_task(room.main_loop())
-                Destroyer.room_tasks[room_id] = room_task
+            # Keep loops started before the Destroyer, e.g. by a command handled during the first sync
+            if room.deletion_turned_on and room_id not in Destroyer.room_tasks:
+                active.append(room)
+        
+        # Spawn all room loops at once. Rooms without a stored event scan their history concurrently,
+        # bounded so a restart does not flood the homeserver with pagination requests.
+        scan_limiter = asyncio.Semaphore(STARTUP_SCAN_CONCURRENCY)
+        Destroyer.room_tasks.update({
+            room.room_id: asyncio.create_task(room.main_loop(scan_limiter), name=f"destroy:{room.room_id}")
+            for room in active
+        })
+    
+    @staticmethod
+    async def redact(client: AsyncClient, room_id: str, event_id: str):
+        """Redact an event through the shared worker pool, or directly if the pool is not running"""
+        if Destroyer.redact_queue is None:
+            return await send_room_redact(client, room_id, event_id)
+        
+        future = asyncio.get_running_loop().create_future()
+        await Destroyer.redact_queue.put((room_id, event_id, future))
+        return await future
+    
+    async def redact_worker(self):
+        """Send queued redactions one at a time. Rate limited requests are retried by send_room_redact."""
+        queue = Destroyer.redact_queue
+        while True:
+            room_id, event_id, future = await queue.get()
+            try:
+                # The room's loop may have been stopped while the redaction was queued
+                if future.cancelled():
+                    continue
+                try:
+                    redact_resp = await send_room_redact(self.client, room_id, event_id)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(redact_resp)
+            finally:
+                queue.task_done()
+    
+    async def on_room_event(self, room: MatrixRoom, event: Event):
+        """Callback for new timeline events. Wakes the loop of the room they were sent in."""
+        if isinstance(event, RoomMemberEvent) and event.state_key == self.client.user_id:
+            await self.on_own_membership(room, event)
+            return
+        
+        destroy_room = Room.room_cache.get(room.room_id, None)
+        if not destroy_room or not destroy_room.deletion_turned_on:
+            return
+        if event.source.get("type", "default") in PERSIST_EVENT_TYPES:
+            return
+        destroy_room.notify_event(event)
+    
+    async def on_sync(self, response: SyncResponse):
+        """Callback for sync responses. Forgets rooms the bot left or was kicked or banned from."""
+        for room_id in response.rooms.leave:
+            logger.debug("Left room %s, evicting it", room_id)
+            # nio does not catch errors raised by callbacks - one would stop the sync loop
+            try:
+                await Room.evict(room_id)
+            except Exception as e:
+                logger.error("Failed to evict room %s with error: %s", room_id, e)
+    
+    async def on_own_membership(self, room: MatrixRoom, event: RoomMemberEvent):
+        """Resume deletion in rooms the bot rejoins"""
+        if event.membership == "join" and room.room_id not in Destroyer.room_tasks:
+            destroy_room = Room.get_existing(self.client, self.storage, room.room_id)
+            if destroy_room and destroy_room.deletion_turned_on:
+                Destroyer.start_room_loop(destroy_room)
     
     @staticmethod
     def start_room_loop(room: Room):
-        if room.room_id in Destroyer.room_tasks.keys():
-            logger.error(f"Room {room.room_id} already exists in task queue")
+        if room.room_id in Destroyer.room_tasks:
+            logger.error("Room %s already exists in task queue", room.room_id)
             return False
         
-        main_loop = asyncio.get_event_loop()
-        room_task = main_loop.create_task(room.main_loop())
+        room_task = asyncio.create_task(room.main_loop(), name=f"destroy:{room.room_id}")
         Destroyer.room_tasks[room.room_id] = room_task
         
         return True
     
     @staticmethod
-    def stop_room_loop(room: Room):
-        if room.room_id not in Destroyer.room_tasks.keys():
-            logger.error(f"Room {room.room_id} is not in task queue")
+    async def stop_room_loop(room: Room):
+        if room.room_id not in Destroyer.room_tasks:
+            logger.error("Room %s is not in task queue", room.room_id)
             return False
         
         task = Destroyer.room_tasks.pop(room.room_id)
-        was_canceled = task.cancel()
+        if task.done():
+            # The loop has already ended - report an error it died with instead of raising it
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Room %s loop failed with error: %s", room.room_id, task.exception())
+            return True
+        
+        task.cancel()
+        # Wait for the loop to unwind, so its frame is released before returning
+        await asyncio.gather(task, return_exceptions=True)
         
-        return was_canceled
+        return True
         
             
     
@@ -109,7 +109,9 @@ async def main(args):
         # Create tasks for bot to perform asynchronously
         async def after_first_sync(client: AsyncClient):
             await client.synced.wait()
-            client.destroyer = destroy_loop.Destroyer(client, store)
+            client.destroyer = destroy_loop.Destroyer(
+                client, store, config.page_size, config.redact_workers
+            )
 
         sync_forever_task = asyncio.create_task(
             client.sync_forever(60000, full_state=True, loop_sleep_time=30000)
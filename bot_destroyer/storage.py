@@ -1,5 +1,7 @@
 import logging
-from typing import Any, Dict, List
+import threading
+from functools import lru_cache, wraps
+from typing import Any, Dict, List, Optional
 
 # The latest migration version of the database.
 #
@@ -8,10 +10,36 @@ from typing import Any, Dict, List
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 2
+latest_migration_version = 4
 
 logger = logging.getLogger(__name__)
 
+# Queries on the room loop's path, translated for the database once in Storage.__init__
+_SET_ROOM_EVENT_SQL = (
+    "UPDATE last_room_events SET event_id= ?, timestamp=?, batch_token_start=?, batch_token_end=? WHERE room_id =?"
+)
+_GET_ROOM_ALL_SQL = (
+    "SELECT room_id, event_id, timestamp, delete_after, deletion_turned_on, batch_token_start, batch_token_end "
+    "FROM last_room_events WHERE room_id =?"
+)
+
+
+def _locked(method):
+    """Hold the connection lock while a storage method runs, so it can be called from worker threads"""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+@lru_cache(maxsize=64)
+def _translate(sql: str) -> str:
+    """Translate sqlite ? placeholders to postgres %s ones. Queries are a small fixed set, so cache them."""
+    return sql.replace("?", "%s")
+
 
 class Storage:
     def __init__(self, database_config: Dict[str, str]):
@@ -26,12 +54,19 @@ class Storage:
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
         """
+        # Serializes use of the shared cursor. Room loops run their writes in worker threads.
+        self._lock = threading.RLock()
+        # Rows returned by get_room_all, dropped whenever the room is written to
+        self._row_cache: Dict[str, Dict[str, Any]] = {}
         self.conn = self._get_database_connection(
             database_config["type"], database_config["connection_string"]
         )
         self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
 
+        self._sql_set_room_event = self._translate_for_db(_SET_ROOM_EVENT_SQL)
+        self._sql_get_room_all = self._translate_for_db(_GET_ROOM_ALL_SQL)
+
         # Try to check the current migration version
         migration_level = 0
         try:
@@ -53,8 +88,13 @@ class Storage:
         if database_type == "sqlite":
             import sqlite3
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
+            # Initialize a connection to the database, with autocommit on.
+            # Access from worker threads is serialized by the storage lock.
+            conn = sqlite3.connect(
+                connection_string, isolation_level=None, check_same_thread=False
+            )
+
+            return conn
         elif database_type == "postgres":
             import psycopg2
 
@@ -141,6 +181,66 @@ class Storage:
             self._execute("UPDATE migration_version SET version = 2")
 
             logger.info("Database migrated to v2")
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # room_id lookups are served by the primary key. Index the deletion flag, so the rooms
+            # with deletion turned on can be loaded without scanning every room.
+            self._execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_last_room_events_deletion
+                ON last_room_events (deletion_turned_on)
+                """
+            )
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+        if current_migration_version < 4:
+            logger.info("Migrating the database from v3 to v4...")
+
+            # Store deletion_turned_on as a 0/1 integer instead of a '0'/'1' string.
+            # Rebuild the table, as older sqlite versions cannot alter or drop columns.
+            self._execute("BEGIN")
+            self._execute(
+                """
+                CREATE TABLE last_room_events_v4 (
+                    room_id VARCHAR(80) PRIMARY KEY,
+                    event_id VARCHAR(80),
+                    timestamp TEXT,
+                    delete_after TEXT,
+                    deletion_turned_on INTEGER NOT NULL DEFAULT 0,
+                    batch_token_start VARCHAR(80),
+                    batch_token_end VARCHAR(80)
+                )
+                """
+            )
+            self._execute(
+                """
+                INSERT INTO last_room_events_v4 (
+                    room_id, event_id, timestamp, delete_after, deletion_turned_on, batch_token_start, batch_token_end
+                )
+                SELECT
+                    room_id, event_id, timestamp, delete_after,
+                    CASE WHEN deletion_turned_on IN ('1', 't', 'T') THEN 1 ELSE 0 END,
+                    batch_token_start, batch_token_end
+                FROM last_room_events
+                """
+            )
+            # Dropping the table also drops its deletion_turned_on index
+            self._execute("DROP TABLE last_room_events")
+            self._execute("ALTER TABLE last_room_events_v4 RENAME TO last_room_events")
+            self._execute(
+                """
+                CREATE INDEX idx_last_room_events_deletion
+                ON last_room_events (deletion_turned_on)
+                """
+            )
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 4")
+            self._execute("COMMIT")
+
+            logger.info("Database migrated to v4")
 
     def _execute(self, *args) -> None:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
@@ -151,10 +251,17 @@ class Storage:
             args: Arguments passed to cursor.execute.
         """
         if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
+            self.cursor.execute(_translate(args[0]), *args[1:])
         else:
             self.cursor.execute(*args)
 
+    def _translate_for_db(self, sql: str) -> str:
+        """Translate a query written with sqlite placeholders for the database in use"""
+        if self.db_type == "postgres":
+            return _translate(sql)
+        return sql
+
+    @_locked
     def delete_uri(self, filename: str):
         """Delete a uri entry via its filename"""
         self._execute(
@@ -164,6 +271,7 @@ class Storage:
             ((filename,)),
         )
 
+    @_locked
     def get_uri(self, filename):
         """Get the uri of a file by the filename"""
 
@@ -180,6 +288,7 @@ class Storage:
             return row[0]
         return None
 
+    @_locked
     def set_uri(self, filename, uri):
         """Create a new URI for a file with filename"""
         self._execute(
@@ -197,43 +306,31 @@ class Storage:
             ),
         )
         
-    def create_room(self, room_id:str):
+    @_locked
+    def create_room(self, room_id:str) -> bool:
+        """Create a room entry if it does not exist yet. Returns whether a new entry was inserted."""
+        self._row_cache.pop(room_id, None)
         self._execute(
             """
-            INSERT INTO last_room_events (room_id) VALUES(?)
+            INSERT INTO last_room_events (room_id) VALUES(?) ON CONFLICT (room_id) DO NOTHING
         """,
             (
                 room_id,
             ),
         )
+        return self.cursor.rowcount == 1
         
-    def get_room(self, room_id:str) -> str:
-        self._execute("SELECT room_id FROM last_room_events WHERE room_id= ?;", (room_id,))
-        id = self.cursor.fetchone()
-        if id:
-            return id[0]
-        return id
-    
-    def get_all_rooms(self) -> List[str]:
-        self._execute("SELECT room_id FROM last_room_events;", ())
-        rows = self.cursor.fetchall()
-        return [row[0] for row in rows]
-        
+    @_locked
     def set_room_event(self, room_id:str, event_id:str, timestamp:str, batch_token_start:str, batch_token_end:str):
-        self._execute(
-            """
-            UPDATE last_room_events SET event_id= ?, timestamp=?, batch_token_start=?, batch_token_end=? WHERE room_id =?
-        """,
-            (
-                event_id,
-                timestamp,
-                batch_token_start,
-                batch_token_end,
-                room_id,
-            ),
+        self._row_cache.pop(room_id, None)
+        self.cursor.execute(
+            self._sql_set_room_event,
+            (event_id, timestamp, batch_token_start, batch_token_end, room_id),
         )
         
+    @_locked
     def set_delete_after(self, room_id:str, delete_after: str):
+        self._row_cache.pop(room_id, None)
         self._execute(
             """
             UPDATE last_room_events SET delete_after= ? WHERE room_id =?
@@ -244,79 +341,61 @@ class Storage:
             ),
         )
         
+    @_locked
     def set_deletion_turned_on(self, room_id:str, deletion_turned_on: bool):
+        self._row_cache.pop(room_id, None)
         self._execute(
             """
             UPDATE last_room_events SET deletion_turned_on= ? WHERE room_id =?
         """,
             (
-                deletion_turned_on,
+                1 if deletion_turned_on else 0,
                 room_id,
             ),
         )
     
-    def get_room_event(self, room_id:str):
-        self._execute(
-            """
-            SELECT event_id, timestamp, batch_token_start, batch_token_end FROM last_room_events WHERE room_id =?
-        """,
-            (
-                room_id,
-            ),
-        )
-        
-        row = self.cursor.fetchone()
+    @_locked
+    def get_room_all(self, room_id:str) -> Optional[Dict[str, Any]]:
+        """Get all fields of a room, or None if it is not stored"""
+        row = self._row_cache.get(room_id)
+        if row is not None:
+            return dict(row)
         
-        if row:
-            return {
-                "room_id": room_id,
-                "event_id": row[0],
-                "timestamp": row[1],
-                "batch_token_start": row[2],
-                "batch_token_end": row[3]
-            }
-        return None
-    
-    def get_room_all(self, room_id:str):
-        self._execute(
-            """
-            SELECT room_id, event_id, timestamp, delete_after, deletion_turned_on, batch_token_start, batch_token_end FROM last_room_events WHERE room_id =?
-        """,
-            (
-                room_id,
-            ),
-        )
+        self.cursor.execute(self._sql_get_room_all, (room_id,))
         
         row = self.cursor.fetchone()
         
         if row:
-            return {
-                "room_id": row[0],
-                "event_id": row[1],
-                "timestamp": row[2],
-                "delete_after": row[3],
-                "deletion_turned_on": row[4],
-                "batch_token_start": row[5],
-                "batch_token_end": row[6]
-            }
+            self._row_cache[room_id] = self._room_row_to_dict(row)
+            return dict(self._row_cache[room_id])
         return None
     
-    def get_room_deletion(self, room_id:str):
+    @_locked
+    def get_active_rooms_all(self) -> List[Dict[str, Any]]:
+        """Get all fields of every room with deletion turned on and a delay set, in a single query"""
         self._execute(
             """
-            SELECT deletion_turned_on, delete_after FROM last_room_events WHERE room_id =?
+            SELECT room_id, event_id, timestamp, delete_after, deletion_turned_on, batch_token_start, batch_token_end FROM last_room_events
+            WHERE deletion_turned_on = 1 AND delete_after IS NOT NULL AND delete_after != ''
         """,
-            (
-                room_id,
-            ),
+            (),
         )
         
-        row = self.cursor.fetchone()
-        
-        if row:
-            return {
-                "room_id": room_id,
-                "deletion_turned_on": row[0],
-                "delete_after": row[1]
-            }
-        return None
+        return [self._room_row_to_dict(row) for row in self.cursor.fetchall()]
+    
+    @staticmethod
+    def new_room_row(room_id: str) -> Dict[str, Any]:
+        """The fields of a freshly created room entry, without querying the database"""
+        return Storage._room_row_to_dict((room_id, None, None, None, 0, None, None))
+    
+    @staticmethod
+    def _room_row_to_dict(row) -> Dict[str, Any]:
+        return {
+            "room_id": row[0],
+            "event_id": row[1],
+            "timestamp": row[2],
+            "delete_after": row[3],
+            "deletion_turned_on": row[4],
+            "batch_token_start": row[5],
+            "batch_token_end": row[6]
+        }
@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import nio
+
+from bot_destroyer.bot_commands import Command
+from bot_destroyer.storage import Storage
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+class CommandTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_config = Mock()
+
+        self.fake_room = Mock(spec=nio.MatrixRoom)
+        self.fake_room.room_id = "!abcdefg:example.com"
+
+        self.fake_event = Mock(spec=nio.RoomMessageText)
+        self.fake_event.sender = "@admin:example.com"
+
+    def _make_command(self, command: str) -> Command:
+        return Command(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            command,
+            self.fake_room,
+            self.fake_event,
+        )
+
+    def test_parse(self):
+        """Tests that the command verb and arguments are split correctly"""
+        command = self._make_command("delay 5")
+        self.assertEqual(command.verb, "delay")
+        self.assertEqual(command.args, ["5"])
+
+        command = self._make_command("help")
+        self.assertEqual(command.verb, "help")
+        self.assertEqual(command.args, [])
+
+        command = self._make_command("")
+        self.assertEqual(command.verb, "")
+        self.assertEqual(command.args, [])
+
+    @patch("bot_destroyer.bot_commands.Room")
+    def test_process_dispatch(self, fake_room_cls):
+        """Tests that commands are dispatched on their verb"""
+        fake_room_cls.get_existing.return_value = Mock()
+
+        command = self._make_command("delay 5")
+        with patch.object(Command, "_DISPATCH", {"delay": Mock(return_value=make_awaitable(None))}):
+            run_coroutine(command.process())
+            Command._DISPATCH["delay"].assert_called_once_with(command)
+
+    @patch("bot_destroyer.bot_commands.send_text_to_room")
+    def test_set_delay(self, fake_send):
+        """Tests that only positive integer delays are stored"""
+        fake_send.return_value = make_awaitable(None)
+        command = self._make_command("delay")
+        command.room = Mock()
+
+        for delay in ("abc", "1.5", "0", "-5"):
+            run_coroutine(command._set_delay(delay))
+        command.room.set_delete_after.assert_not_called()
+
+        run_coroutine(command._set_delay("5"))
+        command.room.set_delete_after.assert_called_once_with(5)
+
+    @patch("bot_destroyer.bot_commands.send_text_to_room")
+    def test_get_delay(self, fake_send):
+        """Tests that the current delay is reported back to the room"""
+        fake_send.return_value = make_awaitable(None)
+        command = self._make_command("delay")
+        command.room = Mock()
+        command.room.delete_after_m = 5
+
+        run_coroutine(command._delay())
+
+        fake_send.assert_called_once_with(
+            self.fake_client,
+            self.fake_room.room_id,
+            "Messages are deleted after 5 minutes",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
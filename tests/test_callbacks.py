@@ -1,9 +1,10 @@
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import nio
 
-from bot_destroyer.callbacks import Callbacks
+from bot_destroyer.callbacks import DUPLICATES_CACHE_SIZE, Callbacks
 from bot_destroyer.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -14,11 +15,14 @@ class CallbacksTestCase(unittest.TestCase):
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.next_batch = "s1234"
 
         self.fake_storage = Mock(spec=Storage)
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.command_prefix = "!c "
 
         self.callbacks = Callbacks(
             self.fake_client, self.fake_storage, self.fake_config
@@ -35,16 +39,175 @@ class CallbacksTestCase(unittest.TestCase):
 
         fake_invite_event = Mock(spec=nio.InviteMemberEvent)
         fake_invite_event.sender = "@some_other_fake_user:example.com"
+        fake_invite_event.state_key = self.fake_client.user_id
 
         # Pretend that attempting to join a room is always successful
         self.fake_client.join.return_value = make_awaitable(None)
 
+        # Pretend that the joined room has no history
+        fake_messages = Mock(spec=nio.RoomMessagesResponse)
+        fake_messages.chunk = []
+        self.fake_client.room_messages.return_value = fake_messages
+
         # Pretend that we received an invite event
         run_coroutine(self.callbacks.invite(fake_room, fake_invite_event))
 
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+        # Check that only the joined room's timeline was fetched
+        self.fake_client.sync.assert_not_called()
+        self.assertEqual(self.fake_client.room_messages.call_args.args[0], fake_room_id)
+
+    def test_invite_requests_room_keys(self):
+        """Tests that keys are requested once per megolm session after joining"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        fake_invite_event = Mock(spec=nio.InviteMemberEvent)
+        fake_invite_event.sender = "@some_other_fake_user:example.com"
+        fake_invite_event.state_key = self.fake_client.user_id
+
+        self.fake_client.join.return_value = nio.JoinResponse(fake_room.room_id)
+        self.fake_client.outgoing_key_requests = {}
+
+        # Two events share a session, a third one uses another session
+        fake_events = []
+        for session_id in ("session_a", "session_a", "session_b"):
+            fake_event = Mock(spec=nio.MegolmEvent)
+            fake_event.session_id = session_id
+            fake_events.append(fake_event)
+        fake_messages = Mock(spec=nio.RoomMessagesResponse)
+        fake_messages.chunk = fake_events
+        self.fake_client.room_messages.return_value = fake_messages
+
+        run_coroutine(self.callbacks.invite(fake_room, fake_invite_event))
+
+        self.assertEqual(self.fake_client.request_room_key.call_count, 2)
+        self.assertEqual(self.fake_client.receive_response.call_count, 2)
+
+    @patch("bot_destroyer.callbacks.asyncio.sleep")
+    def test_invite_join_backoff(self, fake_sleep):
+        """Tests that failed joins are retried with exponential backoff"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        fake_invite_event = Mock(spec=nio.InviteMemberEvent)
+        fake_invite_event.sender = "@some_other_fake_user:example.com"
+        fake_invite_event.state_key = self.fake_client.user_id
+
+        # Pretend that joining always fails
+        self.fake_client.join.return_value = nio.JoinError("Rate limited")
+
+        run_coroutine(self.callbacks.invite(fake_room, fake_invite_event))
+
+        self.assertEqual(self.fake_client.join.call_count, 3)
+        self.assertEqual([c.args[0] for c in fake_sleep.call_args_list], [1, 2])
+        self.fake_client.room_messages.assert_not_called()
+
+    @patch("bot_destroyer.callbacks.Command")
+    def test_message_without_prefix(self, fake_command):
+        """Tests that plain chat messages are dropped before any other check"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.power_levels = Mock()
+
+        fake_event = Mock(spec=nio.RoomMessageText)
+        fake_event.body = "just chatting"
+        fake_event.sender = "@some_other_fake_user:example.com"
+
+        run_coroutine(self.callbacks._message(fake_room, fake_event))
+
+        fake_room.power_levels.get_user_level.assert_not_called()
+        fake_command.assert_not_called()
+
+    @patch("bot_destroyer.callbacks.send_text_to_room")
+    @patch("bot_destroyer.callbacks.create_private_room")
+    @patch("bot_destroyer.callbacks.find_private_msg")
+    def test_send_msg_queued_until_invite(
+        self, fake_find_private_msg, fake_create_private_room, fake_send_text_to_room
+    ):
+        """Tests that messages to a new room are held until the user is invited"""
+        fake_room_id = "!abcdefg:example.com"
+        mxid = "@some_other_fake_user:example.com"
+        fake_find_private_msg.return_value = None
+        fake_create_private_room.return_value = nio.RoomCreateResponse(fake_room_id)
+        fake_send_text_to_room.return_value = make_awaitable(None)
+        self.callbacks.items_to_send = 1
+        self.callbacks.main_loop = Mock()
+
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = fake_room_id
+        fake_room.display_name = "DM"
+
+        fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        fake_member_event.event_id = "$invite"
+        fake_member_event.sender = self.fake_client.user
+        fake_member_event.state_key = mxid
+        fake_member_event.membership = "invite"
+        fake_member_event.server_timestamp = time.time() * 1000
+
+        async def send_then_invite():
+            await self.callbacks.send_msg(mxid, "Hello", "text")
+            fake_send_text_to_room.assert_not_called()
+            self.assertIn(fake_room_id, self.callbacks.rooms_pending)
+
+            await self.callbacks.member(fake_room, fake_member_event)
+
+        run_coroutine(send_then_invite())
+
+        fake_send_text_to_room.assert_called_once_with(self.fake_client, fake_room_id, "Hello")
+        self.assertEqual(self.callbacks.rooms_pending, {})
+        self.assertEqual(self.callbacks.user_rooms_pending, {})
+        self.callbacks.main_loop.cancel.assert_called_once()
+        # The user's lock is dropped once no rooms are pending for them
+        self.assertEqual(self.callbacks.user_locks, {})
+
+    def test_member_without_invite(self):
+        """Tests that member events other than our pending invites do not take a user lock"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.display_name = "Room"
+
+        fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        fake_member_event.event_id = "$join"
+        fake_member_event.sender = "@some_other_fake_user:example.com"
+        fake_member_event.state_key = "@some_other_fake_user:example.com"
+        fake_member_event.membership = "join"
+        fake_member_event.server_timestamp = time.time() * 1000
+
+        run_coroutine(self.callbacks.member(fake_room, fake_member_event))
+
+        self.assertEqual(self.callbacks.user_locks, {})
+
+    def test_should_process(self):
+        """Tests that duplicate events are skipped and the oldest ids are evicted"""
+        self.assertTrue(self.callbacks.should_process("$event0"))
+        self.assertFalse(self.callbacks.should_process("$event0"))
+
+        # Fill the cache so that the first event gets evicted
+        for i in range(1, DUPLICATES_CACHE_SIZE + 1):
+            self.assertTrue(self.callbacks.should_process(f"$event{i}"))
+
+        self.assertEqual(len(self.callbacks.received_ids), DUPLICATES_CACHE_SIZE)
+        self.assertFalse(self.callbacks.should_process(f"$event{DUPLICATES_CACHE_SIZE}"))
+        self.assertTrue(self.callbacks.should_process("$event0"))
+
+    def test_is_admin(self):
+        """Tests that admin status follows the room's current power levels"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.power_levels = Mock()
+        fake_room.power_levels.get_user_level.return_value = 100
+
+        sender = "@admin:example.com"
+        self.assertTrue(self.callbacks._is_admin(fake_room, sender))
+        fake_room.power_levels.get_user_level.assert_called_once_with(sender)
+
+        # A demotion applied from the state of a sync takes effect without any callback
+        fake_room.power_levels.get_user_level.return_value = 0
+        self.assertFalse(self.callbacks._is_admin(fake_room, sender))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,689 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from bot_destroyer.destroy_loop import DEFAULT_PAGE_SIZE, Destroyer, Room
+from bot_destroyer.storage import Storage
+
+from tests.utils import run_coroutine
+
+
+async def iterate(items):
+    """Produce `items` as an async iterable"""
+    for item in items:
+        yield item
+
+
+def make_event(event_id: str, age_m: float, event_type: str = "m.room.message") -> Mock:
+    """Create a fake timeline event that was sent `age_m` minutes ago"""
+    event = Mock(spec=nio.Event)
+    event.event_id = event_id
+    event.server_timestamp = int((time.time() - age_m * 60) * 1000)
+    event.source = {"type": event_type, "sender": "@some_user:example.com"}
+    return event
+
+
+class RoomTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.access_token = "abc123"
+        self.fake_client.next_batch = "s1234"
+        self.fake_client.rooms = {}
+        # The homeserver does not support timestamp lookups unless a test says otherwise
+        self.fake_client.send.return_value = Mock(
+            status=404, json=AsyncMock(return_value={"errcode": "M_UNRECOGNIZED"})
+        )
+
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_room_id = "!abcdefg:example.com"
+        self.fake_storage.get_room_all.return_value = {
+            "room_id": self.fake_room_id,
+            "event_id": None,
+            "timestamp": None,
+            "delete_after": "10",
+            "deletion_turned_on": 1,
+            "batch_token_start": None,
+            "batch_token_end": None,
+        }
+
+        self.room = Room(self.fake_client, self.fake_storage, self.fake_room_id)
+
+    def tearDown(self) -> None:
+        Room.room_cache.clear()
+        Destroyer.room_tasks.clear()
+        Destroyer.timestamp_lookup_supported = True
+
+    def test_room_cache(self):
+        """Tests that created and loaded rooms are memoized"""
+        self.fake_storage.get_room_all.reset_mock()
+        self.fake_storage.create_room.return_value = True
+        self.fake_storage.new_room_row.side_effect = Storage.new_room_row
+
+        room = Room.create_new(self.fake_client, self.fake_storage, self.fake_room_id)
+        self.fake_storage.create_room.assert_called_once_with(self.fake_room_id)
+        # A newly inserted room is not read back
+        self.fake_storage.get_room_all.assert_not_called()
+        self.assertIsNone(room.delete_after_m)
+
+        self.assertIs(Room.get_existing(self.fake_client, self.fake_storage, self.fake_room_id), room)
+
+    def test_event_expired(self):
+        """Tests that expiry follows the room's delay, including after it is changed"""
+        event = make_event("$a", 15)
+        self.assertTrue(self.room.event_expired(event))
+        self.assertLess(self.room.get_time_to_expiry_in_min(event.server_timestamp), 0)
+
+        self.room.set_delete_after(20)
+        self.fake_storage.set_delete_after.assert_called_once_with(self.fake_room_id, 20)
+        self.assertEqual(self.room.delete_after_ms, 20 * 60_000)
+        self.assertFalse(self.room.event_expired(event))
+        self.assertAlmostEqual(self.room.get_time_to_expiry_in_min(event.server_timestamp), 5, places=1)
+
+        # An event expires once more than the delay has passed
+        current_ms = event.server_timestamp + 20 * 60_000
+        self.assertFalse(self.room.event_expired(event, current_ms))
+        self.assertTrue(self.room.event_expired(event, current_ms + 1))
+        self.assertEqual(self.room.get_time_to_expiry_in_min(event.server_timestamp, current_ms), 0)
+
+    def test_get_existing(self):
+        """Tests that an existing room is loaded with a single query"""
+        self.fake_storage.get_room_all.reset_mock()
+
+        room = Room.get_existing(self.fake_client, self.fake_storage, self.fake_room_id)
+
+        self.fake_storage.get_room_all.assert_called_once_with(self.fake_room_id)
+        self.assertEqual(room.delete_after_m, 10)
+
+        self.fake_storage.get_room_all.return_value = None
+        self.assertIsNone(Room.get_existing(self.fake_client, self.fake_storage, "!unknown:example.com"))
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_events(self, fake_send_room_redact):
+        """Tests that all events are redacted and failures are raised"""
+        fake_send_room_redact.return_value = nio.RoomRedactResponse(
+            "$redaction", self.fake_room_id
+        )
+        run_coroutine(self.room.redact_events(iterate(["$a", "$b", "$c"])))
+        self.assertEqual(
+            sorted(c.args[2] for c in fake_send_room_redact.call_args_list),
+            ["$a", "$b", "$c"],
+        )
+
+        fake_send_room_redact.return_value = nio.RoomRedactError("Forbidden", "M_FORBIDDEN")
+        with self.assertRaises(Exception):
+            run_coroutine(self.room.redact_events(iterate(["$a"])))
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_events_stops_on_failure(self, fake_send_room_redact):
+        """Tests that no more events are consumed once a redaction has failed"""
+        fake_send_room_redact.return_value = nio.RoomRedactError("Forbidden", "M_FORBIDDEN")
+        consumed = []
+
+        async def event_ids():
+            for i in range(100):
+                consumed.append(i)
+                # Give the redactions a chance to complete
+                await asyncio.sleep(0)
+                yield f"${i}"
+
+        with self.assertRaises(Exception):
+            run_coroutine(self.room.redact_events(event_ids()))
+        self.assertLess(len(consumed), 100)
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_events_raises_on_error(self, fake_send_room_redact):
+        """Tests that an error raised by a redaction request is raised, not dropped with its task"""
+
+        async def fake_redact(client, room_id, event_id):
+            if event_id == "$a":
+                raise ConnectionError("Connection lost")
+            return nio.RoomRedactResponse("$redaction", room_id)
+
+        fake_send_room_redact.side_effect = fake_redact
+
+        with self.assertRaises(ConnectionError):
+            run_coroutine(self.room.redact_events(iterate(["$a", "$b", "$c"])))
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_events_waits_on_failure(self, fake_send_room_redact):
+        """Tests that redactions in flight finish before a failure is raised"""
+        redacted = []
+
+        async def fake_redact(client, room_id, event_id):
+            if event_id == "$a":
+                return nio.RoomRedactError("Forbidden", "M_FORBIDDEN")
+            await asyncio.sleep(0.01)
+            redacted.append(event_id)
+            return nio.RoomRedactResponse("$redaction", room_id)
+
+        fake_send_room_redact.side_effect = fake_redact
+
+        async def event_ids():
+            yield "$b"
+            yield "$a"
+            # Let the failure be seen while $b is still in flight
+            await asyncio.sleep(0)
+            yield "$c"
+
+        with self.assertRaises(Exception):
+            run_coroutine(self.room.redact_events(event_ids()))
+        self.assertEqual(redacted, ["$b"])
+
+    def test_iter_expired_event_ids(self):
+        """Tests that expired events are produced oldest first up to the last event"""
+        self.room.last_event_id = "$last"
+        self.fake_client.room_messages.side_effect = [
+            nio.RoomMessagesResponse(
+                self.fake_room_id,
+                [make_event("$old1", 30), make_event("$topic", 25, "m.room.topic"), make_event("$old2", 20)],
+                "t0",
+                "t1",
+            ),
+            nio.RoomMessagesResponse(
+                self.fake_room_id, [make_event("$old3", 15), make_event("$last", 12), make_event("$after", 11)], "t1", "t2"
+            ),
+        ]
+
+        async def collect(start, end):
+            return [event_id async for event_id in self.room.iter_expired_event_ids(start, end)]
+
+        self.assertEqual(run_coroutine(collect(None, "t0")), ["$old1", "$old2", "$old3"])
+
+        # A non-expired event before the last event is an error
+        self.fake_client.room_messages.side_effect = [
+            nio.RoomMessagesResponse(self.fake_room_id, [make_event("$old1", 30), make_event("$new", 1)], "t0", "t1"),
+        ]
+        with self.assertRaises(Exception):
+            run_coroutine(collect(None, "t0"))
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_delete_previous_events(self, fake_send_room_redact):
+        """Tests that expired events before the last event are redacted"""
+        fake_send_room_redact.return_value = nio.RoomRedactResponse(
+            "$redaction", self.fake_room_id
+        )
+        self.room.last_event_id = "$last"
+        self.room.batch_token_end = "t5"
+
+        # The backwards scan reaches the start of the room without a redaction by the bot
+        back_page = nio.RoomMessagesResponse(self.fake_room_id, [], "t5", None)
+        # The forwards scan finds two expired messages, a state event and the last event
+        front_page = nio.RoomMessagesResponse(
+            self.fake_room_id,
+            [
+                make_event("$old1", 30),
+                make_event("$topic", 25, "m.room.topic"),
+                make_event("$old2", 20),
+                make_event("$last", 15),
+            ],
+            "t0",
+            "t2",
+        )
+        self.fake_client.room_messages.side_effect = [back_page, front_page]
+
+        run_coroutine(self.room.delete_previous_events())
+
+        self.assertEqual(
+            sorted(c.args[2] for c in fake_send_room_redact.call_args_list),
+            ["$old1", "$old2"],
+        )
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_delete_previous_events_pages(self, fake_send_room_redact):
+        """Tests that expired events spread over several pages are all redacted"""
+        fake_send_room_redact.return_value = nio.RoomRedactResponse(
+            "$redaction", self.fake_room_id
+        )
+        self.room.last_event_id = "$last"
+        self.room.batch_token_end = "t5"
+
+        back_page = nio.RoomMessagesResponse(self.fake_room_id, [], "t5", None)
+        front_pages = [
+            nio.RoomMessagesResponse(
+                self.fake_room_id, [make_event("$old1", 30), make_event("$old2", 25)], "t0", "t1"
+            ),
+            nio.RoomMessagesResponse(
+                self.fake_room_id, [make_event("$old3", 20), make_event("$last", 15)], "t1", "t2"
+            ),
+        ]
+        self.fake_client.room_messages.side_effect = [back_page, *front_pages]
+
+        run_coroutine(self.room.delete_previous_events())
+
+        self.assertEqual(
+            sorted(c.args[2] for c in fake_send_room_redact.call_args_list),
+            ["$old1", "$old2", "$old3"],
+        )
+
+    def test_fetch_first_event_id(self):
+        """Tests that the newest expired event is found, filtering persisted events on the server"""
+        page = nio.RoomMessagesResponse(
+            self.fake_room_id,
+            [
+                make_event("$new", 1),
+                make_event("$expired", 15),
+                make_event("$older", 30),
+            ],
+            "t2",
+            "t1",
+        )
+        self.fake_client.room_messages.return_value = page
+
+        self.assertEqual(run_coroutine(self.room.fetch_first_event_id()), "$expired")
+        self.assertEqual(self.room.last_event_id, "$expired")
+        self.fake_storage.set_room_event.assert_called_once()
+        # Without a timestamp lookup the scan starts at the sync position
+        self.assertEqual(self.fake_client.room_messages.call_args.args[1], "s1234")
+
+        message_filter = self.fake_client.room_messages.call_args.kwargs["message_filter"]
+        self.assertIn("m.room.topic", message_filter["not_types"])
+        self.assertNotIn("m.room.message", message_filter["not_types"])
+
+    def test_fetch_first_event_id_skips_fresh_pages(self):
+        """Tests that pages without expired events are skipped until an expired event is found"""
+        fresh_page = nio.RoomMessagesResponse(
+            self.fake_room_id, [make_event("$new", 1), make_event("$newish", 5)], "t3", "t2"
+        )
+        empty_page = nio.RoomMessagesResponse(self.fake_room_id, [], "t2", "t1")
+        old_page = nio.RoomMessagesResponse(
+            self.fake_room_id, [make_event("$fresh", 9), make_event("$expired", 15)], "t1", "t0"
+        )
+        self.fake_client.room_messages.side_effect = [fresh_page, empty_page, old_page]
+
+        self.assertEqual(run_coroutine(self.room.fetch_first_event_id()), "$expired")
+        self.assertEqual(self.fake_client.room_messages.call_count, 3)
+
+        self.assertIsNone(self.room.pending_event_timestamp)
+
+        # Without any expired event the scan stops at the start of the room
+        oldest = make_event("$newish", 5)
+        self.fake_client.room_messages.side_effect = [
+            nio.RoomMessagesResponse(self.fake_room_id, [make_event("$new", 1), oldest], "t1", None)
+        ]
+        self.assertIsNone(run_coroutine(self.room.fetch_first_event_id()))
+        # The loop can sleep until the oldest event seen expires
+        self.assertEqual(self.room.pending_event_timestamp, oldest.server_timestamp)
+
+    def test_fetch_first_event_id_concurrent(self):
+        """Tests that rooms scanned concurrently each paginate with their own tokens"""
+        other_room = Room.from_row(
+            self.fake_client,
+            self.fake_storage,
+            dict(self.fake_storage.get_room_all.return_value, room_id="!other:example.com"),
+        )
+        # Two pages per room, the expired event is on the second one
+        pages = {
+            (room_id, token): nio.RoomMessagesResponse(room_id, chunk, token, end)
+            for room_id, prefix in ((self.fake_room_id, "a"), (other_room.room_id, "b"))
+            for token, chunk, end in (
+                ("s1234", [make_event(f"${prefix}new", 1)], f"{prefix}1"),
+                (f"{prefix}1", [make_event(f"${prefix}expired", 15)], f"{prefix}2"),
+            )
+        }
+
+        async def room_messages(room_id, start, **kwargs):
+            # Let the other room's scan run in between pages
+            await asyncio.sleep(0)
+            return pages[(room_id, start)]
+
+        self.fake_client.room_messages.side_effect = room_messages
+
+        async def scan_both():
+            return await asyncio.gather(self.room.fetch_first_event_id(), other_room.fetch_first_event_id())
+
+        self.assertEqual(run_coroutine(scan_both()), ["$aexpired", "$bexpired"])
+        self.assertEqual(self.room.batch_token_start, "a2")
+        self.assertEqual(other_room.batch_token_start, "b2")
+
+    def test_fetch_first_event_id_from_cutoff(self):
+        """Tests that the scan starts at the cutoff when the homeserver can look events up by timestamp"""
+        timestamp_resp = Mock(status=200)
+        timestamp_resp.json = AsyncMock(return_value={"event_id": "$expired", "origin_server_ts": 0})
+        self.fake_client.send.return_value = timestamp_resp
+        self.fake_client.room_context.return_value = nio.RoomContextResponse(
+            self.fake_room_id, "c0", "c1", None, [], [make_event("$fresh", 9)], []
+        )
+        self.fake_client.room_messages.return_value = nio.RoomMessagesResponse(
+            self.fake_room_id, [make_event("$fresh", 9), make_event("$expired", 15)], "c1", "t0"
+        )
+
+        self.assertEqual(run_coroutine(self.room.fetch_first_event_id()), "$expired")
+
+        path = self.fake_client.send.call_args.args[1]
+        self.assertTrue(path.startswith("/_matrix/client/v1/rooms/"))
+        self.assertIn("/timestamp_to_event?", path)
+        self.assertIn("dir=b", path)
+        self.assertEqual(self.fake_client.room_context.call_args.args[1], "$expired")
+        self.assertEqual(self.fake_client.room_messages.call_args.args[1], "c1")
+        timestamp_resp.release.assert_called_once()
+
+    def test_find_event_before_unsupported(self):
+        """Tests that the timestamp lookup is not retried once the homeserver does not recognize it"""
+        not_found = Mock(status=404, json=AsyncMock(return_value={"errcode": "M_NOT_FOUND"}))
+        self.fake_client.send.return_value = not_found
+
+        # No event before the timestamp - the homeserver still supports the lookup
+        self.assertIsNone(run_coroutine(self.room.find_event_before(0)))
+        self.assertTrue(Destroyer.timestamp_lookup_supported)
+        not_found.release.assert_called_once()
+
+        unrecognized = Mock(status=404, json=AsyncMock(return_value={"errcode": "M_UNRECOGNIZED"}))
+        self.fake_client.send.return_value = unrecognized
+        self.assertIsNone(run_coroutine(self.room.find_event_before(0)))
+        self.assertFalse(Destroyer.timestamp_lookup_supported)
+        unrecognized.release.assert_called_once()
+
+        self.fake_client.send.reset_mock()
+        self.assertIsNone(run_coroutine(self.room.find_event_before(0)))
+        self.fake_client.send.assert_not_called()
+
+    def test_set_next_event(self):
+        """Tests that the next deletable event after the last one is stored"""
+        self.room.last_event_id = "$last"
+        first_context = nio.RoomContextResponse(
+            self.fake_room_id, "c0", "c1", None, [], [make_event("$member", 5, "m.room.member")], []
+        )
+        second_context = nio.RoomContextResponse(
+            self.fake_room_id, "c1", "c2", None, [], [make_event("$next", 4)], []
+        )
+        self.fake_client.room_context.side_effect = [first_context, second_context]
+
+        run_coroutine(self.room.set_next_event())
+
+        self.assertEqual(self.room.last_event_id, "$next")
+        self.assertEqual(self.fake_client.room_context.call_args.args[1], "$member")
+
+    def test_disable_room_loop(self):
+        """Tests that disabling a room waits for its loop to be cancelled"""
+
+        async def start_and_stop():
+            self.assertTrue(Destroyer.start_room_loop(self.room))
+            task = Destroyer.room_tasks[self.fake_room_id]
+            # Let the loop start waiting for events
+            await asyncio.sleep(0)
+
+            self.assertTrue(await self.room.disable_room_loop())
+            self.assertTrue(task.done())
+            self.assertNotIn(self.fake_room_id, Destroyer.room_tasks)
+
+            # The loop is already stopped
+            self.assertFalse(await self.room.disable_room_loop())
+
+        run_coroutine(start_and_stop())
+        self.fake_storage.set_deletion_turned_on.assert_called_with(self.fake_room_id, False)
+
+    @patch("bot_destroyer.destroy_loop.send_text_to_room", new_callable=AsyncMock)
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_error_ends_loop(self, fake_send_room_redact, fake_send_text_to_room):
+        """Tests that a redaction error ends the room loop with a message and the loop can still be stopped"""
+        fake_send_room_redact.side_effect = ConnectionError("Connection lost")
+        self.room.last_event_id = "$last"
+        self.room.timestamp = int((time.time() - 15 * 60) * 1000)
+
+        async def run_and_stop():
+            with patch.object(Room, "delete_previous_events", AsyncMock()):
+                await self.room.main_loop()
+            fake_send_text_to_room.assert_awaited_once()
+
+            # A loop that died with an error is stopped without raising it
+            async def failed_loop():
+                raise ConnectionError("Connection lost")
+
+            Destroyer.room_tasks[self.fake_room_id] = asyncio.create_task(failed_loop())
+            await asyncio.sleep(0)
+            self.assertTrue(await Destroyer.stop_room_loop(self.room))
+            self.assertNotIn(self.fake_room_id, Destroyer.room_tasks)
+
+        run_coroutine(run_and_stop())
+
+    def test_wake(self):
+        """Tests that new events wake the room loop up early"""
+        event = make_event("$new", 0)
+
+        async def notify_and_wait():
+            self.assertFalse(await self.room.wait_for_wake(0.01))
+
+            self.room.notify_event(event)
+            self.room.notify_event(make_event("$newer", 0))
+            self.assertTrue(await self.room.wait_for_wake(10))
+
+            # The wake up is consumed
+            self.assertFalse(await self.room.wait_for_wake(0.01))
+
+        run_coroutine(notify_and_wait())
+        self.assertEqual(self.room.pending_event_timestamp, event.server_timestamp)
+
+
+class DestroyerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.access_token = "abc123"
+        self.fake_client.next_batch = "s1234"
+        self.fake_client.rooms = {}
+        # The homeserver does not support timestamp lookups unless a test says otherwise
+        self.fake_client.send.return_value = Mock(
+            status=404, json=AsyncMock(return_value={"errcode": "M_UNRECOGNIZED"})
+        )
+
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_storage.get_active_rooms_all.return_value = [
+            {
+                "room_id": f"!room{i}:example.com",
+                "event_id": None,
+                "timestamp": None,
+                "delete_after": "10",
+                "deletion_turned_on": 1,
+                "batch_token_start": None,
+                "batch_token_end": None,
+            }
+            for i in range(5)
+        ]
+
+    def tearDown(self) -> None:
+        Room.room_cache.clear()
+        Destroyer.room_tasks.clear()
+        Destroyer.redact_queue = None
+        Destroyer.redact_workers = []
+        Destroyer.timestamp_lookup_supported = True
+        Room.page_size = DEFAULT_PAGE_SIZE
+
+    async def stop_destroyer(self):
+        """Cancel the tasks started by the Destroyer and wait for them to finish"""
+        tasks = [*Destroyer.room_tasks.values(), *Destroyer.redact_workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def test_load_rooms(self):
+        """Tests that active rooms are loaded into the cache with a single query on start"""
+        cached_room = Room.from_row(
+            self.fake_client, self.fake_storage, self.fake_storage.get_active_rooms_all.return_value[0]
+        )
+        # Deletion was turned off since the room was stored
+        cached_room.deletion_turned_on = False
+        Room.room_cache[cached_room.room_id] = cached_room
+
+        # A loop was started before the Destroyer was created
+        running_room = Room.from_row(
+            self.fake_client, self.fake_storage, self.fake_storage.get_active_rooms_all.return_value[1]
+        )
+        Room.room_cache[running_room.room_id] = running_room
+
+        async def start():
+            self.assertTrue(Destroyer.start_room_loop(running_room))
+            running_task = Destroyer.room_tasks[running_room.room_id]
+            Destroyer(self.fake_client, self.fake_storage)
+            self.assertIs(Destroyer.room_tasks[running_room.room_id], running_task)
+            await self.stop_destroyer()
+
+        run_coroutine(start())
+
+        self.fake_storage.get_active_rooms_all.assert_called_once_with()
+        self.fake_storage.get_room_all.assert_not_called()
+        self.assertEqual(len(Room.room_cache), 5)
+        # Rooms already in the cache are reused
+        self.assertIs(Room.room_cache[cached_room.room_id], cached_room)
+        # Only rooms with deletion still turned on are started
+        self.assertNotIn(cached_room.room_id, Destroyer.room_tasks)
+        self.assertEqual(len(Destroyer.room_tasks), 4)
+
+    def test_own_membership(self):
+        """Tests that rooms the bot leaves are evicted on sync and resumed when it rejoins"""
+        room_id = "!room1:example.com"
+        matrix_room = nio.MatrixRoom(room_id, self.fake_client.user_id)
+        row = self.fake_storage.get_active_rooms_all.return_value[1]
+        self.fake_storage.get_room_all.return_value = row
+
+        # The bot's ban only arrives in the leave section of a sync, for which no event callbacks are run
+        ban_sync = nio.SyncResponse.from_dict({
+            "next_batch": "s2",
+            "rooms": {
+                "leave": {
+                    room_id: {
+                        "timeline": {
+                            "events": [
+                                {
+                                    "type": "m.room.member",
+                                    "state_key": self.fake_client.user_id,
+                                    "sender": "@admin:example.com",
+                                    "content": {"membership": "ban"},
+                                    "event_id": "$ban",
+                                    "origin_server_ts": 0,
+                                }
+                            ]
+                        },
+                        "state": {"events": []},
+                    }
+                }
+            },
+        })
+
+        join = Mock(spec=nio.RoomMemberEvent)
+        join.state_key = self.fake_client.user_id
+        join.membership = "join"
+
+        async def leave_and_rejoin():
+            destroyer = Destroyer(self.fake_client, self.fake_storage)
+            task = Destroyer.room_tasks[room_id]
+
+            on_sync, response_types = self.fake_client.add_response_callback.call_args.args
+            self.assertEqual(response_types, (nio.SyncResponse,))
+            # The room's loop died with an error, which must not reach the sync loop
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+            async def failed_loop():
+                raise ConnectionError("Connection lost")
+
+            task = Destroyer.room_tasks[room_id] = asyncio.create_task(failed_loop())
+            await asyncio.sleep(0)
+            await on_sync(ban_sync)
+            self.assertNotIn(room_id, Room.room_cache)
+            self.assertNotIn(room_id, Destroyer.room_tasks)
+            self.assertTrue(task.done())
+            # Other rooms are kept
+            self.assertIn("!room0:example.com", Destroyer.room_tasks)
+
+            await destroyer.on_room_event(matrix_room, join)
+            self.assertIn(room_id, Room.room_cache)
+            self.assertIn(room_id, Destroyer.room_tasks)
+
+            await self.stop_destroyer()
+
+        run_coroutine(leave_and_rejoin())
+
+    @patch("bot_destroyer.destroy_loop.send_room_redact")
+    def test_redact_workers(self, fake_send_room_redact):
+        """Tests that redactions of all rooms are sent by a bounded pool of workers"""
+        self.fake_storage.get_active_rooms_all.return_value = []
+        sending = 0
+        max_sending = 0
+
+        async def fake_redact(client, room_id, event_id):
+            nonlocal sending, max_sending
+            sending += 1
+            max_sending = max(max_sending, sending)
+            await asyncio.sleep(0.01)
+            sending -= 1
+            if event_id == "$fail":
+                return nio.RoomRedactError("Forbidden", "M_FORBIDDEN")
+            return nio.RoomRedactResponse("$redaction", room_id)
+
+        fake_send_room_redact.side_effect = fake_redact
+
+        async def redact_all():
+            Destroyer(self.fake_client, self.fake_storage, redact_workers=2)
+            responses = await asyncio.gather(
+                *(Destroyer.redact(self.fake_client, f"!room{i % 3}:example.com", f"${i}") for i in range(6)),
+                Destroyer.redact(self.fake_client, "!room0:example.com", "$fail"),
+            )
+            await self.stop_destroyer()
+            return responses
+
+        responses = run_coroutine(redact_all())
+
+        self.assertEqual(fake_send_room_redact.call_count, 7)
+        self.assertEqual(max_sending, 2)
+        self.assertIsInstance(responses[0], nio.RoomRedactResponse)
+        self.assertIsInstance(responses[-1], nio.RoomRedactError)
+
+    def test_page_size(self):
+        """Tests that history is paginated with the configured page size"""
+        self.fake_storage.get_active_rooms_all.return_value = []
+
+        async def start():
+            Destroyer(self.fake_client, self.fake_storage, page_size=50)
+            await self.stop_destroyer()
+
+        run_coroutine(start())
+
+        self.fake_client.room_messages.return_value = nio.RoomMessagesResponse("!room0:example.com", [], "t1", None)
+        room = Room.from_row(self.fake_client, self.fake_storage, {
+            "room_id": "!room0:example.com",
+            "event_id": None,
+            "timestamp": None,
+            "delete_after": "10",
+            "deletion_turned_on": 0,
+            "batch_token_start": None,
+            "batch_token_end": None,
+        })
+        run_coroutine(room.fetch_first_event_id())
+        self.assertEqual(self.fake_client.room_messages.call_args.kwargs["limit"], 50)
+
+    @patch("bot_destroyer.destroy_loop.STARTUP_SCAN_CONCURRENCY", 2)
+    def test_startup_scan(self):
+        """Tests that enabled rooms scan their history on start, a bounded number at a time"""
+        scanning = set()
+        max_scanning = 0
+
+        async def fake_fetch_first_event_id(room):
+            nonlocal max_scanning
+            scanning.add(room.room_id)
+            max_scanning = max(max_scanning, len(scanning))
+            await asyncio.sleep(0.01)
+            scanning.remove(room.room_id)
+            return None
+
+        async def start():
+            with patch.object(Room, "fetch_first_event_id", fake_fetch_first_event_id):
+                Destroyer(self.fake_client, self.fake_storage)
+                self.assertEqual(len(Destroyer.room_tasks), 5)
+
+                # Let the scans finish, the loops then wait for new events
+                await asyncio.sleep(0.1)
+                for task in Destroyer.room_tasks.values():
+                    self.assertFalse(task.done())
+                await self.stop_destroyer()
+
+        run_coroutine(start())
+        self.assertEqual(max_scanning, 2)
+        self.assertFalse(scanning)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import asyncio
+import unittest
+
+from bot_destroyer.storage import Storage, _translate, latest_migration_version
+
+from tests.utils import run_coroutine
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # An in-memory sqlite database is migrated from scratch for every test
+        self.storage = Storage({"type": "sqlite", "connection_string": ":memory:"})
+
+    def test_migrations(self):
+        """Tests that a new database is migrated to the latest version"""
+        self.storage._execute("SELECT version FROM migration_version")
+        self.assertEqual(self.storage.cursor.fetchone()[0], latest_migration_version)
+
+        self.storage._execute("PRAGMA index_list(last_room_events)")
+        indexes = [row[1] for row in self.storage.cursor.fetchall()]
+        self.assertIn("idx_last_room_events_deletion", indexes)
+
+    def test_migrate_deletion_turned_on(self):
+        """Tests that string deletion flags are migrated to integers"""
+        # Recreate the v3 table, which stored the flag as a string
+        self.storage._execute("DROP TABLE last_room_events")
+        self.storage._execute(
+            """
+            CREATE TABLE last_room_events (
+                room_id VARCHAR(80) PRIMARY KEY,
+                event_id VARCHAR(80),
+                timestamp TEXT,
+                delete_after TEXT,
+                deletion_turned_on VARCHAR(1),
+                batch_token_start VARCHAR(80),
+                batch_token_end VARCHAR(80)
+            )
+            """
+        )
+        for room_id, deletion_turned_on in (("!on", "1"), ("!off", "0"), ("!unset", None)):
+            self.storage._execute(
+                "INSERT INTO last_room_events (room_id, delete_after, deletion_turned_on) VALUES (?, '10', ?)",
+                (room_id, deletion_turned_on),
+            )
+        self.storage._execute("UPDATE migration_version SET version = 3")
+
+        self.storage._run_migrations(3)
+
+        self.assertEqual(self.storage.get_room_all("!on")["deletion_turned_on"], 1)
+        self.assertEqual(self.storage.get_room_all("!off")["deletion_turned_on"], 0)
+        self.assertEqual(self.storage.get_room_all("!unset")["deletion_turned_on"], 0)
+        self.assertEqual(self.storage.get_room_all("!on")["delete_after"], "10")
+        self.assertEqual([row["room_id"] for row in self.storage.get_active_rooms_all()], ["!on"])
+
+    def test_translate_for_db(self):
+        """Tests that queries are only translated for postgres"""
+        sql = "SELECT uri FROM static_media_uris WHERE filename = ?"
+        self.assertEqual(self.storage._translate_for_db(sql), sql)
+
+        self.storage.db_type = "postgres"
+        self.assertEqual(
+            self.storage._translate_for_db(sql), "SELECT uri FROM static_media_uris WHERE filename = %s"
+        )
+
+    def test_create_room(self):
+        """Tests that creating a room twice keeps the existing entry"""
+        self.assertTrue(self.storage.create_room("!a:example.com"))
+        self.storage.set_delete_after("!a:example.com", "10")
+
+        self.assertFalse(self.storage.create_room("!a:example.com"))
+        self.assertEqual(self.storage.get_room_all("!a:example.com")["delete_after"], "10")
+        self.assertEqual(
+            Storage.new_room_row("!b:example.com"),
+            {
+                "room_id": "!b:example.com",
+                "event_id": None,
+                "timestamp": None,
+                "delete_after": None,
+                "deletion_turned_on": 0,
+                "batch_token_start": None,
+                "batch_token_end": None,
+            },
+        )
+
+    def test_worker_threads(self):
+        """Tests that storage methods can run concurrently in worker threads"""
+        room_ids = [f"!{i}:example.com" for i in range(10)]
+        for room_id in room_ids:
+            self.storage.create_room(room_id)
+
+        async def set_events():
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(None, self.storage.set_room_event, room_id, f"${i}", str(i), "s", "e")
+                    for i, room_id in enumerate(room_ids)
+                )
+            )
+
+        run_coroutine(set_events())
+
+        for i, room_id in enumerate(room_ids):
+            self.assertEqual(self.storage.get_room_all(room_id)["event_id"], f"${i}")
+
+    def test_get_room_all_cache(self):
+        """Tests that room rows are cached until the room is written to"""
+        self.storage.create_room("!a:example.com")
+        row = self.storage.get_room_all("!a:example.com")
+
+        # Cached rows are not affected by changes to returned copies
+        row["delete_after"] = "5"
+        self.assertIsNone(self.storage.get_room_all("!a:example.com")["delete_after"])
+
+        self.storage.set_delete_after("!a:example.com", "10")
+        self.assertEqual(self.storage.get_room_all("!a:example.com")["delete_after"], "10")
+        self.storage.set_deletion_turned_on("!a:example.com", True)
+        self.assertEqual(self.storage.get_room_all("!a:example.com")["deletion_turned_on"], 1)
+        self.storage.set_room_event("!a:example.com", "$a", "1000", "s1", "e1")
+        self.assertEqual(self.storage.get_room_all("!a:example.com")["event_id"], "$a")
+
+        self.assertIsNone(self.storage.get_room_all("!unknown:example.com"))
+
+    def test_get_active_rooms_all(self):
+        """Tests that only rooms with deletion turned on and a delay set are loaded"""
+        for room_id in ("!a:example.com", "!b:example.com", "!c:example.com"):
+            self.storage.create_room(room_id)
+        self.storage.set_delete_after("!a:example.com", "10")
+        self.storage.set_deletion_turned_on("!a:example.com", True)
+        self.storage.set_delete_after("!b:example.com", "10")
+        self.storage.set_deletion_turned_on("!b:example.com", False)
+        self.storage.set_deletion_turned_on("!c:example.com", True)
+
+        rows = self.storage.get_active_rooms_all()
+
+        self.assertEqual(rows, [self.storage.get_room_all("!a:example.com")])
+
+
+class TranslateTestCase(unittest.TestCase):
+    def test_translate(self):
+        """Tests that placeholders are translated for postgres and the result is cached"""
+        sql = "UPDATE last_room_events SET delete_after= ? WHERE room_id =?"
+        hits = _translate.cache_info().hits
+
+        self.assertEqual(_translate(sql), "UPDATE last_room_events SET delete_after= %s WHERE room_id =%s")
+        _translate(sql)
+        self.assertEqual(_translate.cache_info().hits, hits + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
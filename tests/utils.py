@@ -8,6 +8,8 @@ def run_coroutine(result: Awaitable[Any]) -> Any:
     loop = asyncio.get_event_loop()
     result = loop.run_until_complete(result)
     loop.close()
+    # Leave a fresh loop behind so later tests can keep creating futures
+    asyncio.set_event_loop(asyncio.new_event_loop())
     return result
 
 